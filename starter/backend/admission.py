@@ -0,0 +1,165 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request
+
+from metrics import registry
+from serialization import jsonify
+
+admission_log = logging.getLogger('trivia.admission')
+
+'''
+DEFAULT_ADMISSION_LIMITS
+    limits per endpoint for the routes that do table-wide work per call:
+    `concurrency` requests in flight per process, and a token bucket per
+    client refilled at `rate` requests per second holding up to `burst`.
+    Either part may be left out.
+'''
+DEFAULT_ADMISSION_LIMITS = {
+  'retrieve_quiz_questions': {'concurrency': 16, 'rate': 10, 'burst': 50},
+  'retrieve_searched_based_questions': {'concurrency': 8, 'rate': 5, 'burst': 25},
+}
+
+'''
+MemoryBucketStore
+    token buckets kept in process memory, keyed by (endpoint, client). The
+    least recently used bucket is dropped once `max_clients` are tracked;
+    a dropped bucket would have refilled anyway while its client was idle.
+    Any object with the same take() method can be configured instead as
+    ADMISSION_BUCKET_STORE, e.g. one backed by a cache shared by every worker.
+'''
+class MemoryBucketStore:
+
+  def __init__(self, max_clients=100000):
+    self.max_clients = max_clients
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._buckets)
+
+  def take(self, key, rate, burst):
+    '''
+    takes one token from the bucket of `key`; returns (True, 0) when one
+    was available, else (False, seconds until the next token)
+    '''
+    now = time.monotonic()
+    with self._lock:
+      bucket = self._buckets.get(key)
+      if bucket is None:
+        tokens = burst
+        while len(self._buckets) >= self.max_clients:
+          self._buckets.popitem(last=False)
+      else:
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        self._buckets.move_to_end(key)
+      allowed = tokens >= 1
+      if allowed:
+        tokens -= 1
+      self._buckets[key] = (tokens, now)
+    return allowed, 0 if allowed else (1 - tokens) / rate
+
+'''
+ConcurrencyLimit
+    non-blocking counter of the requests in flight on one endpoint
+'''
+class ConcurrencyLimit:
+
+  def __init__(self, limit):
+    self.limit = limit
+    self.in_flight = 0
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    with self._lock:
+      if self.in_flight >= self.limit:
+        return False
+      self.in_flight += 1
+      return True
+
+  def release(self):
+    with self._lock:
+      self.in_flight -= 1
+
+def _rejection(status, message, retry_after):
+  response = jsonify({
+    "success": False,
+    "error": status,
+    "message": message
+    })
+  response.status_code = status
+  response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+  return response
+
+'''
+init_admission(app)
+    admission control for the endpoints in ADMISSION_LIMITS (default
+    DEFAULT_ADMISSION_LIMITS), checked before the view runs: a client out of
+    tokens gets 429, and a request finding the endpoint at its concurrency
+    limit gets 503 with Retry-After: ADMISSION_RETRY_AFTER (default 1).
+    Rejections cost no database work, so admitted traffic keeps its latency
+    under overload. Clients are told apart by the remote address or, behind
+    ADMISSION_TRUSTED_PROXIES proxies (default 1), by ADMISSION_CLIENT_HEADER
+    (e.g. X-Forwarded-For): the address the outermost trusted proxy appended,
+    counted from the right, since everything left of it is client supplied.
+    Decisions are counted as trivia_admission_requests_total and requests in
+    flight reported as trivia_admission_in_flight on /metrics.
+    Call it after every route is registered.
+'''
+def init_admission(app):
+  limits = app.config.get('ADMISSION_LIMITS', DEFAULT_ADMISSION_LIMITS)
+  store = app.config.get('ADMISSION_BUCKET_STORE') or MemoryBucketStore(app.config.get('ADMISSION_MAX_CLIENTS', 100000))
+  client_header = app.config.get('ADMISSION_CLIENT_HEADER')
+  trusted_proxies = app.config.get('ADMISSION_TRUSTED_PROXIES', 1)
+  retry_after = app.config.get('ADMISSION_RETRY_AFTER', 1)
+
+  routes = {rule.endpoint: rule.rule for rule in app.url_map.iter_rules()}
+  concurrency = {endpoint: ConcurrencyLimit(limit['concurrency'])
+    for endpoint, limit in limits.items() if limit and limit.get('concurrency')}
+  app.extensions['admission'] = concurrency
+
+  def client_id():
+    if client_header and trusted_proxies > 0:
+      hops = [hop.strip() for hop in request.headers.get(client_header, '').split(',') if hop.strip()]
+      # fewer hops than trusted proxies means the request bypassed them
+      if len(hops) >= trusted_proxies:
+        return hops[-trusted_proxies]
+    return request.remote_addr
+
+  def count(endpoint, result):
+    registry.inc('trivia_admission_requests_total', (('route', routes.get(endpoint, endpoint)), ('result', result)))
+
+  @app.before_request
+  def admit():
+    endpoint = request.endpoint
+    limit = limits.get(endpoint)
+    if not limit or request.method == 'OPTIONS':
+      return None
+    if limit.get('rate'):
+      allowed, wait = store.take((endpoint, client_id()), limit['rate'], limit.get('burst', limit['rate']))
+      if not allowed:
+        count(endpoint, 'throttled')
+        return _rejection(429, 'too many requests', wait)
+    slots = concurrency.get(endpoint)
+    if slots is not None:
+      if not slots.acquire():
+        count(endpoint, 'overloaded')
+        admission_log.warning('%s at its limit of %d requests in flight', endpoint, slots.limit)
+        return _rejection(503, 'service unavailable', retry_after)
+      g.admission_slot = slots
+    count(endpoint, 'admitted')
+    return None
+
+  @app.teardown_request
+  def release_slot(error):
+    slots = g.pop('admission_slot', None)
+    if slots is not None:
+      slots.release()
+
+  def collect():
+    for endpoint, slots in concurrency.items():
+      yield 'trivia_admission_in_flight', (('route', routes.get(endpoint, endpoint)),), slots.in_flight
+  registry.register_collector('admission', collect)
@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.client import HTTPConnection
+
+from sqlalchemy import create_engine, func, select
+
+'''
+Endpoint benchmark
+
+Seeds a throwaway database with synthetic questions, drives every route of
+create_app() through the Flask test client (or a local WSGI server with
+--client wsgi) and prints throughput and p50/p95/p99 latency per route as
+JSON. Pass --compare with an earlier report to flag regressions.
+
+  python benchmark.py --sizes 1000,100000 --requests 200 --output run.json
+  python benchmark.py --sizes 1000 --compare run.json
+'''
+
+DEFAULT_CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+WORDS = ('title', 'river', 'painting', 'league', 'element', 'empire', 'planet', 'novel',
+  'mountain', 'goal', 'album', 'treaty', 'molecule', 'sculpture', 'ocean', 'medal')
+SEED_CHUNK = 10000
+
+def synthetic_questions(count, categories, start_id=1, rng=None):
+  rng = rng or random.Random(0)
+  for question_id in range(start_id, start_id + count):
+    words = rng.sample(WORDS, 5)
+    yield {
+      'id': question_id,
+      'question': 'Which {} is linked to the {} and the {} of question {}?'.format(words[0], words[1], words[2], question_id),
+      'answer': '{} {}'.format(words[3], words[4]),
+      'category_id': rng.randint(1, len(categories)),
+      'difficulty': rng.randint(1, 5)
+    }
+
+def seed_database(url, size, categories):
+  '''
+  loads `size` questions with chunked executemany into a database already
+  migrated by init_schema; one that holds exactly `size` questions is reused
+  '''
+  from models import Question, Category
+
+  engine = create_engine(url)
+  with engine.begin() as connection:
+    existing = connection.execute(select([func.count()]).select_from(Question.__table__)).scalar()
+    if existing == size:
+      return engine
+    connection.execute(Question.__table__.delete())
+    connection.execute(Category.__table__.delete())
+    connection.execute(Category.__table__.insert(), [{'id': index, 'type': name} for index, name in enumerate(categories, 1)])
+    chunk = []
+    for row in synthetic_questions(size, categories):
+      chunk.append(row)
+      if len(chunk) == SEED_CHUNK:
+        connection.execute(Question.__table__.insert(), chunk)
+        chunk = []
+    if chunk:
+      connection.execute(Question.__table__.insert(), chunk)
+    if engine.dialect.name == 'postgresql':
+      # rows were loaded with explicit ids, so move the sequences past them
+      for table in ('questions', 'categories'):
+        connection.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), (SELECT max(id) FROM {0}))".format(table))
+  return engine
+
+def route_plan(size, categories, rng, setup):
+  '''
+  (name, request factory) pairs covering every route; reads first, then
+  writes. Inserts take ids above `size` and the delete routes remove them
+  again in the same order, so the dataset size stays fixed. `setup(method,
+  path, body)` sends an untimed request and returns its JSON body, for the
+  quiz session the /next route deals from and for the session or question
+  each full-response delete removes.
+  '''
+  last_page = max(size // 10, 1)
+  next_id = [size + 1]
+  def take_ids(count):
+    ids = list(range(next_id[0], next_id[0] + count))
+    next_id[0] += count
+    return ids
+  category = lambda: rng.randint(1, len(categories))
+  quiz_category = lambda: {'type': 'bench', 'id': rng.choice([0, category()])}
+  new_question = {'question': 'Benchmark question?', 'answer': 'yes', 'category': '1', 'difficulty': 3}
+  new_quiz = lambda: setup('POST', '/quizzes', {'quiz_category': {'type': 'bench', 'id': 0}})['token']
+  quiz_token = new_quiz()
+  return [
+    ('GET /categories', lambda: ('GET', '/categories', None)),
+    ('GET /questions page 1', lambda: ('GET', '/questions', None)),
+    ('GET /questions deep page', lambda: ('GET', '/questions?page={}'.format(last_page), None)),
+    ('GET /questions keyset', lambda: ('GET', '/questions?after_id={}'.format(rng.randint(1, size)), None)),
+    ('GET /categories/<id>/questions', lambda: ('GET', '/categories/{}/questions'.format(category()), None)),
+    ('POST /questions/search substring', lambda: ('POST', '/questions/search', {'searchTerm': rng.choice(WORDS)})),
+    ('POST /questions/search fulltext', lambda: ('POST', '/questions/search', {'searchTerm': rng.choice(WORDS), 'searchMode': 'fulltext'})),
+    ('POST /questions/quiz', lambda: ('POST', '/questions/quiz', {'previous_questions': rng.sample(range(1, size + 1), min(size, 20)), 'quiz_category': quiz_category()})),
+    ('POST /quizzes', lambda: ('POST', '/quizzes', {'quiz_category': quiz_category()})),
+    ('POST /quizzes/<token>/next', lambda: ('POST', '/quizzes/{}/next'.format(quiz_token), None)),
+    ('GET /questions/export category', lambda: ('GET', '/questions/export?category={}&min_id={}'.format(category(), max(size - 1000, 1)), None)),
+    ('GET /stats', lambda: ('GET', '/stats', None)),
+    ('GET /metrics', lambda: ('GET', '/metrics', None)),
+    ('POST /questions', lambda: ('POST', '/questions', new_question)),
+    ('POST /questions/bulk', lambda: ('POST', '/questions/bulk', [new_question] * 10)),
+    ('DELETE /questions/<id>?return=minimal', lambda: ('DELETE', '/questions/{}?return=minimal'.format(take_ids(1)[0]), None)),
+    ('DELETE /questions?ids=', lambda: ('DELETE', '/questions?ids=' + ','.join(str(n) for n in take_ids(10)), None)),
+    ('DELETE /questions/<id>', lambda: ('DELETE', '/questions/{}'.format(setup('POST', '/questions', new_question)['created']), None)),
+    ('DELETE /quizzes/<token>', lambda: ('DELETE', '/quizzes/{}'.format(new_quiz()), None)),
+  ]
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+  return sorted_values[index]
+
+def summarize(latencies, statuses, elapsed):
+  ordered = sorted(latencies)
+  return {
+    'requests': len(ordered),
+    'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed else None,
+    'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+    'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+    'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+    'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses))}
+  }
+
+class TestClientDriver:
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def request(self, method, path, body):
+    response = self.client.open(path, method=method, json=body)
+    return response.status_code, response.get_data()
+
+  def close(self):
+    pass
+
+class WSGIDriver:
+  '''
+  serves the app from a werkzeug server thread and talks to it over a
+  keep-alive HTTP connection, so WSGI and socket overhead are included
+  '''
+  def __init__(self, app):
+    from werkzeug.serving import make_server
+    self.server = make_server('127.0.0.1', 0, app, threaded=True)
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    self.connection = HTTPConnection('127.0.0.1', self.server.server_port)
+
+  def request(self, method, path, body):
+    payload = json.dumps(body) if body is not None else None
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    self.connection.request(method, path, body=payload, headers=headers)
+    response = self.connection.getresponse()
+    return response.status, response.read()
+
+  def close(self):
+    self.connection.close()
+    self.server.shutdown()
+
+def run_size(args, size, workdir):
+  from flaskr import create_app
+  from models import init_schema
+
+  categories = DEFAULT_CATEGORIES[:args.categories] + ['Category {}'.format(n) for n in range(len(DEFAULT_CATEGORIES) + 1, args.categories + 1)]
+  url = args.database.format(size=size) if args.database else 'sqlite:///' + os.path.join(workdir, 'bench_{}.db'.format(size))
+  # one client hammers every route, so per-client throttling would only measure the 429 path
+  app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'ADMISSION_LIMITS': {}})
+  started = time.time()
+  with app.app_context():
+    init_schema()
+  seed_database(url, size, categories)
+  seed_seconds = time.time() - started
+  driver = WSGIDriver(app) if args.client == 'wsgi' else TestClientDriver(app)
+  rng = random.Random(args.seed)
+  routes = {}
+  def setup(method, path, body):
+    return json.loads(driver.request(method, path, body)[1].decode('utf-8'))
+  try:
+    for name, make_request in route_plan(size, categories, rng, setup):
+      if args.routes and not any(fragment in name for fragment in args.routes):
+        continue
+      for _ in range(args.warmup):
+        driver.request(*make_request())
+      latencies, statuses = [], []
+      route_started = time.perf_counter()
+      for _ in range(args.requests):
+        method, path, body = make_request()
+        request_started = time.perf_counter()
+        statuses.append(driver.request(method, path, body)[0])
+        latencies.append(time.perf_counter() - request_started)
+      routes[name] = summarize(latencies, statuses, time.perf_counter() - route_started)
+  finally:
+    driver.close()
+
+  return {
+    'size': size,
+    'categories': len(categories),
+    'database': url.split(':', 1)[0],
+    'seed_seconds': round(seed_seconds, 3),
+    'routes': routes
+  }
+
+def compare(report, baseline, threshold):
+  '''
+  returns the (size, route, metric, before, after) tuples whose p95 latency
+  grew or throughput fell by more than `threshold` (a fraction)
+  '''
+  regressions = []
+  previous = {(run['size'], name): stats for run in baseline['runs'] for name, stats in run['routes'].items()}
+  for run in report['runs']:
+    for name, stats in run['routes'].items():
+      before = previous.get((run['size'], name))
+      if before is None:
+        continue
+      if stats['p95_ms'] > before['p95_ms'] * (1 + threshold):
+        regressions.append((run['size'], name, 'p95_ms', before['p95_ms'], stats['p95_ms']))
+      if before['throughput_rps'] and stats['throughput_rps'] < before['throughput_rps'] * (1 - threshold):
+        regressions.append((run['size'], name, 'throughput_rps', before['throughput_rps'], stats['throughput_rps']))
+  return regressions
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the trivia API endpoints against synthetic datasets.')
+  parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated question counts')
+  parser.add_argument('--categories', type=int, default=len(DEFAULT_CATEGORIES))
+  parser.add_argument('--database', help='database URL, may contain {size}; defaults to a SQLite file per size')
+  parser.add_argument('--workdir', help='directory for the SQLite files (kept between runs)')
+  parser.add_argument('--client', choices=('test', 'wsgi'), default='test')
+  parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+  parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route')
+  parser.add_argument('--routes', nargs='*', help='only run routes whose name contains one of these')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+  parser.add_argument('--compare', help='earlier JSON report to check for regressions')
+  parser.add_argument('--threshold', type=float, default=0.10, help='allowed regression as a fraction')
+  args = parser.parse_args(argv)
+
+  workdir = args.workdir or tempfile.mkdtemp(prefix='trivia-bench-')
+  os.makedirs(workdir, exist_ok=True)
+  report = {
+    'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'client': args.client,
+    'requests_per_route': args.requests,
+    'runs': [run_size(args, int(size), workdir) for size in args.sizes.split(',')]
+  }
+
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, 'w') as handle:
+      handle.write(output)
+
+  if args.compare:
+    with open(args.compare) as handle:
+      regressions = compare(report, json.load(handle), args.threshold)
+    for size, name, metric, before, after in regressions:
+      print('REGRESSION size={} {} {}: {} -> {}'.format(size, name, metric, before, after), file=sys.stderr)
+    return 1 if regressions else 0
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
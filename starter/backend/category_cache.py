@@ -0,0 +1,47 @@
+import threading
+import time
+
+'''
+CategoryCache
+    in-process copy of the categories table as an id -> type map. It reloads
+    from `loader` (an iterable of (id, type) rows) when the 'categories'
+    version in `versions` moves, and after `max_age` seconds so writes made
+    by other worker processes are picked up. The returned map is shared and
+    must be treated as read-only.
+'''
+class CategoryCache:
+
+  def __init__(self, loader, versions, max_age=300):
+    self.loader = loader
+    self.versions = versions
+    self.max_age = max_age
+    self._lock = threading.Lock()
+    self._types = None
+    self._version = None
+    self._loaded_at = None
+
+  def _ensure_loaded(self):
+    version = self.versions.get('categories')
+    if (self._types is not None and self._version == version
+        and time.time() - self._loaded_at < self.max_age):
+      return self._types
+    with self._lock:
+      types = {category_id: category_type for category_id, category_type in self.loader()}
+      self._types, self._version, self._loaded_at = types, version, time.time()
+      return types
+
+  def types(self):
+    return self._ensure_loaded()
+
+  def count(self):
+    return len(self._ensure_loaded())
+
+  def type_of(self, category_id):
+    try:
+      return self._ensure_loaded().get(int(category_id))
+    except (TypeError, ValueError):
+      return None
+
+  def invalidate(self):
+    with self._lock:
+      self._types = None
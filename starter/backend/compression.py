@@ -0,0 +1,185 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html')
+DEFAULT_MIN_SIZE = 1024
+
+def _gzip(data, level):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+  return compressor.compress(data) + compressor.flush()
+
+def _brotli(data, level):
+  return brotli.compress(data, quality=level)
+
+'''
+ENCODINGS
+    content codings the app can produce, most preferred first, as
+    (compress(data, level), config key of the level, default level)
+'''
+ENCODINGS = OrderedDict()
+if brotli is not None:
+  ENCODINGS['br'] = (_brotli, 'COMPRESS_BROTLI_QUALITY', 5)
+ENCODINGS['gzip'] = (_gzip, 'COMPRESS_LEVEL', 6)
+
+'''
+CompressedCache
+    LRU cache of compressed response bodies keyed by (ETag, coding), bounded
+    by `max_bytes`. An ETag already changes with the table versions a page is
+    built from, so entries never need invalidating; old tags simply age out.
+'''
+class CompressedCache:
+
+  def __init__(self, max_bytes=16 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self._entries = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry
+
+  def put(self, key, body, mimetype):
+    with self._lock:
+      if len(body) > self.max_bytes:
+        return
+      previous = self._entries.pop(key, None)
+      if previous is not None:
+        self._bytes -= len(previous[0])
+      self._entries[key] = (body, mimetype)
+      self._bytes += len(body)
+      while self._bytes > self.max_bytes:
+        oldest, (evicted, evicted_mimetype) = self._entries.popitem(last=False)
+        self._bytes -= len(evicted)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+def negotiated_encoding():
+  '''
+  the best content coding both the client (Accept-Encoding) and the app
+  support, or None for identity; always None when COMPRESS is off
+  '''
+  if not current_app.config.get('COMPRESS', True):
+    return None
+  return request.accept_encodings.best_match(list(ENCODINGS))
+
+def representation_tag(etag, encoding):
+  '''
+  ETag of one encoding of a page: a compressed body is a different
+  representation and must not share the identity tag
+  '''
+  return etag if encoding is None else '{}-{}'.format(etag, encoding)
+
+def _level(encoding):
+  compress, level_key, default_level = ENCODINGS[encoding]
+  return current_app.config.get(level_key, default_level)
+
+def _compressible(response):
+  return (response.status_code == 200 and response.mimetype in COMPRESSIBLE_MIMETYPES
+    and 'Content-Encoding' not in response.headers and not response.direct_passthrough)
+
+def _stream(chunks, encoding, level):
+  if encoding == 'br':
+    compressor = brotli.Compressor(quality=level)
+    process, flush, finish = compressor.process, compressor.flush, compressor.finish
+  else:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+  try:
+    for chunk in chunks:
+      if isinstance(chunk, str):
+        chunk = chunk.encode('utf-8')
+      # flush every chunk so a streamed export keeps arriving incrementally
+      data = process(chunk) + flush()
+      if data:
+        yield data
+    yield finish()
+  finally:
+    close = getattr(chunks, 'close', None)
+    if close is not None:
+      close()
+
+def compress_response(response, encoding, etag=None):
+  '''
+  compresses `response` in place with `encoding` when its type compresses
+  well and its body reaches COMPRESS_MIN_SIZE; streamed bodies are compressed
+  chunk by chunk. With `etag`, the compressed body is kept in the app's
+  CompressedCache for cached_response().
+  '''
+  if not _compressible(response):
+    return response
+  response.vary.add('Accept-Encoding')
+  if encoding is None:
+    return response
+
+  level = _level(encoding)
+  if response.is_streamed:
+    response.response = _stream(response.response, encoding, level)
+    response.headers.pop('Content-Length', None)
+  else:
+    data = response.get_data()
+    if len(data) < current_app.config.get('COMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE):
+      return response
+    compress = ENCODINGS[encoding][0]
+    response.set_data(compress(data, level))
+    cache = current_app.extensions.get('compressed_cache')
+    if etag is not None and cache is not None:
+      cache.put((etag, encoding), response.get_data(), response.mimetype)
+  response.headers['Content-Encoding'] = encoding
+  return response
+
+def cached_response(etag, encoding):
+  '''
+  a 200 response with the compressed body cached for this ETag and coding,
+  or None; the view does not have to run again on a hit
+  '''
+  cache = current_app.extensions.get('compressed_cache')
+  if encoding is None or cache is None:
+    return None
+  entry = cache.get((etag, encoding))
+  if entry is None:
+    return None
+  body, mimetype = entry
+  response = current_app.response_class(body, mimetype=mimetype)
+  response.headers['Content-Encoding'] = encoding
+  response.vary.add('Accept-Encoding')
+  return response
+
+'''
+init_compression(app)
+    negotiates gzip, or brotli when the brotli package is installed, from
+    Accept-Encoding for JSON, NDJSON and CSV responses of COMPRESS_MIN_SIZE
+    bytes or more (default 1024); COMPRESS = False turns it off. Pages served
+    through http_cache.conditional keep their compressed bodies in a
+    CompressedCache of COMPRESS_CACHE_BYTES, so a hot page is compressed once
+    per ETag. Levels are set by COMPRESS_LEVEL and COMPRESS_BROTLI_QUALITY.
+'''
+def init_compression(app):
+  app.extensions['compressed_cache'] = CompressedCache(app.config.get('COMPRESS_CACHE_BYTES', 16 * 1024 * 1024))
+
+  @app.after_request
+  def compress(response):
+    if request.method == 'HEAD':
+      return response
+    return compress_response(response, negotiated_encoding())
@@ -0,0 +1,78 @@
+import threading
+import time
+
+'''
+QuestionCounters
+    question totals per category and per difficulty, kept in memory and moved
+    incrementally by Question.insert/delete so handlers never count rows.
+    reconcile() recomputes them from `loader` (an iterable of
+    (category, difficulty, count) rows from one GROUP BY) and records how far
+    the incremental counts had drifted; reads reconcile automatically once
+    the last reconciliation is older than `interval` seconds, which also picks
+    up writes made by other worker processes.
+'''
+class QuestionCounters:
+
+  def __init__(self, loader, interval=300):
+    self.loader = loader
+    self.interval = interval
+    self._lock = threading.Lock()
+    self._histogram = None
+    self._total = 0
+    self.reconciled_at = None
+    self.last_drift = 0
+
+  def reconcile(self):
+    histogram = {}
+    total = 0
+    for category, difficulty, count in self.loader():
+      histogram.setdefault(str(category), {})[difficulty] = count
+      total += count
+    with self._lock:
+      self.last_drift = total - self._total if self._histogram is not None else 0
+      self._histogram = histogram
+      self._total = total
+      self.reconciled_at = time.time()
+    return self.last_drift
+
+  def _ensure_fresh(self):
+    if self._histogram is None or time.time() - self.reconciled_at >= self.interval:
+      self.reconcile()
+
+  def invalidate(self):
+    with self._lock:
+      self._histogram = None
+
+  def _move(self, category, difficulty, delta):
+    if self._histogram is None:
+      return
+    bucket = self._histogram.setdefault(str(category), {})
+    bucket[difficulty] = bucket.get(difficulty, 0) + delta
+    if bucket[difficulty] <= 0:
+      del bucket[difficulty]
+    self._total += delta
+
+  def added(self, category, difficulty):
+    with self._lock:
+      self._move(category, difficulty, 1)
+
+  def removed(self, category, difficulty):
+    with self._lock:
+      self._move(category, difficulty, -1)
+
+  def total(self):
+    self._ensure_fresh()
+    return self._total
+
+  def count(self, category):
+    self._ensure_fresh()
+    with self._lock:
+      return sum(self._histogram.get(str(category), {}).values())
+
+  def histogram(self):
+    '''
+    {category: {difficulty: count}} copy of the current counts
+    '''
+    self._ensure_fresh()
+    with self._lock:
+      return {category: dict(bucket) for category, bucket in self._histogram.items() if bucket}
@@ -0,0 +1,196 @@
+import math
+import numbers
+import random
+
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+ADAPTIVE_START = 3
+ADAPTIVE_STEP = 0.5
+# weight of a question halves for every level its difficulty is away from the target
+FALLOFF = 0.5
+# weighted draws rejected in a row before falling back to weighing only the unused questions
+MAX_REJECTIONS = 16
+# alias tables cached per pool; explicit curves come from clients, so keep this bounded
+MAX_TABLES = 64
+
+'''
+AliasTable
+    Vose's alias method over (key, weight) pairs: built in O(n), sample()
+    returns a key with probability weight / total in O(1). Pairs with a
+    weight of zero are never drawn; an empty table is falsy.
+'''
+class AliasTable:
+  __slots__ = ('keys', 'probability', 'alias')
+
+  def __init__(self, weighted):
+    pairs = [(key, float(weight)) for key, weight in weighted if weight > 0]
+    total = sum(weight for key, weight in pairs)
+    count = len(pairs)
+    self.keys = [key for key, weight in pairs]
+    self.probability = [1.0] * count
+    self.alias = list(range(count))
+
+    scaled = [weight * count / total for key, weight in pairs]
+    small = [index for index, value in enumerate(scaled) if value < 1.0]
+    large = [index for index, value in enumerate(scaled) if value >= 1.0]
+    while small and large:
+      less, more = small.pop(), large.pop()
+      self.probability[less] = scaled[less]
+      self.alias[less] = more
+      scaled[more] -= 1.0 - scaled[less]
+      (small if scaled[more] < 1.0 else large).append(more)
+    # whatever is left over is 1.0 up to rounding error
+    for index in small + large:
+      self.probability[index] = 1.0
+
+  def __len__(self):
+    return len(self.keys)
+
+  def sample(self):
+    column = random.randrange(len(self.keys))
+    if random.random() < self.probability[column]:
+      return self.keys[column]
+    return self.keys[self.alias[column]]
+
+'''
+DifficultyCurve
+    relative weight of each difficulty level: either centred on a target
+    difficulty, falling off by FALLOFF per level, or an explicit
+    {difficulty: weight} mapping in which unlisted levels weigh nothing.
+    `key` is hashable so alias tables can be cached per curve.
+'''
+class DifficultyCurve:
+  __slots__ = ('key', 'target', '_weights')
+
+  def __init__(self, target=None, weights=None):
+    self.target = target
+    self._weights = dict(weights) if weights is not None else None
+    if self._weights is None:
+      self.key = ('target', target)
+    else:
+      self.key = ('weights', tuple(sorted(self._weights.items())))
+
+  def weight(self, difficulty):
+    if self._weights is not None:
+      return self._weights.get(difficulty, 0)
+    if difficulty is None:
+      return 0
+    return FALLOFF ** abs(difficulty - self.target)
+
+  def covered(self, levels):
+    '''
+    number of members of `levels` ({difficulty: sequence}) in levels the
+    curve gives a positive weight, i.e. the questions a draw can return
+    '''
+    return sum(len(members) for difficulty, members in levels.items() if self.weight(difficulty) > 0)
+
+  def table(self, levels):
+    '''
+    alias table over the difficulty levels of a pool ({difficulty: sequence
+    of questions}), each level weighted by its size times its curve weight
+    '''
+    return AliasTable((difficulty, self.weight(difficulty) * len(members)) for difficulty, members in levels.items())
+
+def weighted_draw(levels, table, curve, excluded=(), id_of=None):
+  '''
+  draws one candidate from `levels` ({difficulty: sequence of candidates}),
+  each with probability proportional to the curve weight of its difficulty
+  and skipping candidates whose id is in `excluded`. `table` is
+  curve.table(levels), usually cached by the caller. While few candidates
+  are excluded this is O(1) expected; once draws keep hitting excluded ones
+  the unused candidates are weighed directly. Returns None when no unused
+  candidate has a positive weight.
+  '''
+  if id_of is None:
+    id_of = lambda candidate: candidate
+  if table:
+    for attempt in range(MAX_REJECTIONS):
+      members = levels[table.sample()]
+      candidate = members[random.randrange(len(members))]
+      if id_of(candidate) not in excluded:
+        return candidate
+
+  unused = {}
+  for difficulty, members in levels.items():
+    candidates = [candidate for candidate in members if id_of(candidate) not in excluded]
+    if candidates:
+      unused[difficulty] = candidates
+  table = curve.table(unused)
+  if not table:
+    return None
+  return random.choice(unused[table.sample()])
+
+'''
+DifficultyPlan
+    how a quiz picks the difficulty of its next question: a fixed curve, or
+    an adaptive target that moves ADAPTIVE_STEP up after every correct answer
+    and down after every wrong one, within MIN_DIFFICULTY..MAX_DIFFICULTY
+'''
+class DifficultyPlan:
+  __slots__ = ('curve', 'adaptive')
+
+  def __init__(self, curve, adaptive=False):
+    self.curve = curve
+    self.adaptive = adaptive
+
+  def record(self, correct):
+    if not self.adaptive:
+      return
+    step = ADAPTIVE_STEP if correct else -ADAPTIVE_STEP
+    target = min(MAX_DIFFICULTY, max(MIN_DIFFICULTY, self.curve.target + step))
+    self.curve = DifficultyCurve(target=target)
+
+  def format(self):
+    if self.curve.target is None:
+      return {}
+    return {'target_difficulty': self.curve.target}
+
+def _is_number(value):
+  # JSON bodies may carry NaN and Infinity, which no curve can weigh
+  return isinstance(value, numbers.Real) and not isinstance(value, bool) and math.isfinite(value)
+
+def read_difficulty_plan(body):
+  '''
+  read_difficulty_plan(body)
+    reads the optional difficulty settings of a quiz request and returns
+    (plan, None), with plan None for the default uniform draw, or
+    (None, message) describing the first problem found:
+      difficulty          target difficulty (a finite number)
+      difficulty_weights  {difficulty: weight} curve, e.g. {"1": 1, "5": 4}
+      adaptive            true to move the target after every answer,
+                          starting from `difficulty` or ADAPTIVE_START
+      answers             for the stateless quiz endpoint, the client's
+                          answers so far as true/false, oldest first
+  '''
+  target = body.get('difficulty')
+  weights = body.get('difficulty_weights')
+  adaptive = body.get('adaptive', False)
+  answers = body.get('answers', [])
+
+  if not isinstance(adaptive, bool):
+    return None, 'adaptive must be true or false'
+  if target is not None and not _is_number(target):
+    return None, 'difficulty must be a finite number'
+  if not isinstance(answers, list) or not all(isinstance(answer, bool) for answer in answers):
+    return None, 'answers must be a list of true/false values'
+
+  if weights is not None:
+    if target is not None or adaptive:
+      return None, 'difficulty_weights cannot be combined with difficulty or adaptive'
+    if not isinstance(weights, dict) or not weights:
+      return None, 'difficulty_weights must be a non-empty object'
+    curve_weights = {}
+    for difficulty, weight in weights.items():
+      if not str(difficulty).lstrip('-').isdigit() or not _is_number(weight) or weight < 0:
+        return None, 'difficulty_weights must map integer difficulties to finite non-negative numbers'
+      curve_weights[int(difficulty)] = weight
+    if not any(curve_weights.values()):
+      return None, 'difficulty_weights must give some difficulty a positive weight'
+    return DifficultyPlan(DifficultyCurve(weights=curve_weights)), None
+
+  if target is None and not adaptive:
+    return None, None
+  plan = DifficultyPlan(DifficultyCurve(target=target if target is not None else ADAPTIVE_START), adaptive)
+  for answer in answers:
+    plan.record(answer)
+  return plan, None
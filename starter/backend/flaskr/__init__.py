@@ -1,46 +1,229 @@
 import os
-from flask import Flask, request, abort, jsonify
+import io
+import csv
+import json
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy 
 from flask_cors import CORS
-import random
+import time
 from colorama import Fore , Style
-from sqlalchemy import and_
-from sqlalchemy.sql import func
 
-from models import setup_db, Question, Category
+from models import setup_db, init_schema, db, Question, Category, category_cache, fragment_cache, question_counters, question_sampler, question_search, search_cache
+from search_cache import normalize_term
+from quiz_sessions import QuizSessionStore, WeightedQuizSession
+from difficulty import read_difficulty_plan
+from search import FULLTEXT, SEARCH_MODES
+from http_cache import conditional
+from routing import read_only
+from serialization import init_json, jsonify, dumps, RawJSON, RawJSONArray
+from profiling import init_profiling
+from metrics import init_metrics, registry, cache_collector
+from lifecycle import init_lifecycle
+from admission import init_admission
+from compression import init_compression
+from snapshot import current_snapshot, snapshot_for
 
 QUESTIONS_PER_PAGE = 10
 CATEGORIES_PER_PAGE = 10
+EXPORT_COLUMNS = Question.format_columns
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
 
-def paginate_questions(request, selection):
-  page = request.args.get('page', 1, type=int)
-  start =  (page - 1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
-  
-  questions = [question.format() for question in selection]
-  current_questions = questions[start:end]
-  return current_questions
+def paginate(request, selection, model, per_page, columns=None, total=None):
+  '''
+  paginate(request, selection, model, per_page, columns=None, total=None)
+    pushes the page window down to the database instead of slicing .all().
+    ?page= issues LIMIT/OFFSET on the (ordered) selection; ?after_id= switches
+    to a keyset seek on model.id so deep pages cost the same as page 1.
+    Only `columns` (default model.projection()) are selected, so no ORM
+    objects are built. Returns (rows, total, next_cursor) where next_cursor
+    is the id to pass as ?after_id= for the following page, or None on the
+    last page. The COUNT query is skipped when the caller already knows
+    the total (e.g. from question_counters).
+  '''
+  if total is None:
+    total = selection.order_by(None).count()
+  after_id = request.args.get('after_id', None, type=int)
+
+  if after_id is not None:
+    window = selection.filter(model.id > after_id).order_by(None).order_by(model.id)
+  else:
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      return [], total, None
+    window = selection.offset((page - 1) * per_page)
+
+  # one extra row tells us whether another page exists without a second query
+  rows = window.with_entities(*(columns or model.projection())).limit(per_page + 1).all()
+  next_cursor = rows[per_page - 1].id if len(rows) > per_page else None
+  return rows[:per_page], total, next_cursor
+
+def fetch_fragments(question_ids):
+  '''
+  fetch_fragments(question_ids)
+    {id: encoded JSON} of the given questions that still exist, taken from
+    fragment_cache; misses are fetched in one query and cached
+  '''
+  found, missing = fragment_cache.get_many(question_ids)
+  if missing:
+    generation = fragment_cache.generation
+    for row in db.session.query(*Question.projection()).filter(Question.id.in_(missing)):
+      fragment = dumps(Question.format_row(row))
+      fragment_cache.put(row.id, fragment, generation)
+      found[row.id] = fragment
+  return found
+
+def question_fragments(question_ids):
+  '''
+  question_fragments(question_ids)
+    encoded JSON for each question id, in order (see fetch_fragments).
+    Ids that no longer exist are left out.
+  '''
+  found = fetch_fragments(question_ids)
+  return RawJSONArray(found[question_id] for question_id in question_ids if question_id in found)
+
+def paginate_questions(request, selection, total=None):
+  rows, total, next_cursor = paginate(request, selection, Question, QUESTIONS_PER_PAGE, columns=[Question.id], total=total)
+  return question_fragments([row.id for row in rows]), total, next_cursor
 
 def paginate_categories(request, selection):
-  page = request.args.get('page', 1, type=int)
-  start =  (page - 1) * CATEGORIES_PER_PAGE
-  end = start + CATEGORIES_PER_PAGE
-  
-  categories = [category.format() for category in selection]
-  current_categories = categories[start:end]
-  return current_categories
+  rows, total, next_cursor = paginate(request, selection, Category, CATEGORIES_PER_PAGE)
+  return [Category.format_row(row) for row in rows], total, next_cursor
+
+def paginate_snapshot(request, snapshot, category=None):
+  '''
+  paginate_snapshot(request, snapshot, category=None)
+    same contract as paginate_questions, served from the mmap'd question
+    snapshot without touching the database; also returns the category of
+    the first question on the page
+  '''
+  positions, total, next_cursor = snapshot.window(category, request.args.get('page', 1, type=int),
+    request.args.get('after_id', None, type=int), QUESTIONS_PER_PAGE)
+  first_category = snapshot.category_at(positions[0]) if positions else None
+  return RawJSONArray(snapshot.fragment_at(position) for position in positions), total, next_cursor, first_category
+
+def page_of_ids(request, question_ids):
+  '''
+  page_of_ids(request, question_ids)
+    (ids on the page, total, next_cursor) for an ordered list of ids that was
+    resolved outside the database
+  '''
+  total = len(question_ids)
+  after_id = request.args.get('after_id', None, type=int)
+
+  if after_id is not None:
+    window = [question_id for question_id in question_ids if question_id > after_id]
+    window.sort()
+  else:
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      return [], total, None
+    window = question_ids[(page - 1) * QUESTIONS_PER_PAGE:]
+
+  page_ids = window[:QUESTIONS_PER_PAGE]
+  next_cursor = page_ids[-1] if len(window) > QUESTIONS_PER_PAGE else None
+  return page_ids, total, next_cursor
+
+def validate_question(body):
+  '''
+  validate_question(body)
+    checks one question payload and returns (row, None) with the values to
+    insert, or (None, message) describing the first problem found
+  '''
+  if not isinstance(body, dict):
+    return None, 'question must be a JSON object'
+  for field in ('question', 'answer'):
+    value = body.get(field)
+    if not isinstance(value, str) or not value.strip():
+      return None, '{} must be a non-empty string'.format(field)
+  category = body.get('category')
+  if isinstance(category, bool) or category_cache.type_of(category) is None:
+    return None, 'unknown category {!r}'.format(category)
+  difficulty = body.get('difficulty', 1)
+  if isinstance(difficulty, bool) or not isinstance(difficulty, int):
+    return None, 'difficulty must be an integer'
+  return {
+    'question': body['question'],
+    'answer': body['answer'],
+    'category_id': int(category),
+    'difficulty': difficulty
+  }, None
+
+def read_bulk_rows(request):
+  '''
+  read_bulk_rows(request)
+    yields the payloads of a bulk upload: a JSON array body, or one JSON
+    document per line when sent as application/x-ndjson (read as a stream)
+  '''
+  if request.mimetype in ('application/x-ndjson', 'application/jsonlines'):
+    for line in request.stream:
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        yield json.loads(line.decode('utf-8'))
+      except ValueError:
+        yield None
+  else:
+    body = request.get_json()
+    if not isinstance(body, list):
+      abort(400)
+    for item in body:
+      yield item
+
+def export_rows(rows, export_format, chunk_rows=500):
+  '''
+  export_rows(rows, export_format, chunk_rows=500)
+    encodes (id, question, answer, category, difficulty) tuples as NDJSON or
+    CSV and yields the text in chunks of chunk_rows rows
+  '''
+  if export_format == 'csv':
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(rows, 1):
+      writer.writerow(row)
+      if count % chunk_rows == 0:
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+      yield buffer.getvalue()
+    return
+
+  lines = []
+  for row in rows:
+    lines.append(dumps(Question.format_row(row)))
+    if len(lines) == chunk_rows:
+      lines.append(b'')
+      yield b'\n'.join(lines)
+      lines = []
+  if lines:
+    lines.append(b'')
+    yield b'\n'.join(lines)
 
 def create_app(test_config=None):
   # create and configure the app
+  started = time.perf_counter()
   app = Flask(__name__)
-  configedDB = setup_db(app)
-  if not configedDB:
-    abort(500)
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  init_json(app)
+  # binds the engine lazily; the schema is created by `flask init-db`
+  if app.config.get('SQLALCHEMY_DATABASE_URI'):
+    setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+  else:
+    setup_db(app)
   
   '''
   @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
   '''
   CORS(app, resources={r"/api/*": {"origins": "*"}})
+  init_profiling(app)
+  init_metrics(app)
+  init_compression(app)
+  registry.register_collector('fragments', cache_collector('fragments', fragment_cache))
+  registry.register_collector('search', cache_collector('search', search_cache))
+  registry.register_collector('compressed', cache_collector('compressed', app.extensions['compressed_cache']))
   
 
   '''
@@ -59,19 +242,18 @@ def create_app(test_config=None):
   '''
   
   @app.route('/categories', methods=['GET'])
+  @conditional('categories')
   def retrieve_categories():
     try:
       if request.method != 'GET': abort(405)    
-      categories = Category.query.order_by(Category.id).all()
-        
-      current_categories = {cat.id:cat.type for cat in categories}
+      current_categories = category_cache.types()
 
       return jsonify({
         'success': True,
         'categories': current_categories,
-        'total_categories': len(Category.query.all())
+        'total_categories': category_cache.count()
       })
-    except expression as identifier:
+    except:
       abort(422)
 
   '''
@@ -87,36 +269,72 @@ def create_app(test_config=None):
   Clicking on the page numbers should update the questions. 
   '''
   @app.route('/questions', methods=['GET'])
+  @conditional('questions', 'categories')
   def retrieve_questions():
     if request.method != 'GET': abort(405)    
-    categories = Category.query.order_by(Category.id).all()
-    types = {cat.id:cat.type for cat in categories}
-    randomCategory = str( random.randint(1, len(categories)))
-    questions = Question.query.order_by(Question.id).all()
-    
-    ## * - OPTIONAL - RANDOM FUNCTIONALITY FOR QUESTIONS VIEW  - RANDOMIZES QUESTIONS ON REFRESH
-    #questions = Question.query.filter(Question.category==randomCategory).order_by(Question.id).all()
-    #questions = Question.query.order_by(func.random()).all()
-    ## * - - - - - -
-    current_questions = paginate_questions(request, questions)
-    
-    if len(current_questions)==0:
-      abort(404)  
-    
-    for category in categories:
-      #print('troubleshoot: ', categories, category.id , ' ', questions[0].category, str (category.id) == str (questions[0].category) ) # !Troubleshooting code
-      if str (category.id) == str (questions[0].category):
-        currentCategory = category.type 
+    snapshot = current_snapshot()
+    if snapshot is not None:
+      current_questions, total_questions, next_cursor, first_category = paginate_snapshot(request, snapshot)
+      if len(current_questions)==0:
+        abort(404)
+      types = snapshot.types()
+      currentCategory = snapshot.type_of(first_category)
+    else:
+      types = category_cache.types()
+      selection = Question.query.join(Category).order_by(Question.id)
+      
+      ## * - OPTIONAL - RANDOM FUNCTIONALITY FOR QUESTIONS VIEW  - RANDOMIZES QUESTIONS ON REFRESH
+      #randomCategory = str( random.randint(1, len(types)))
+      #selection = Question.query.filter(Question.category==randomCategory).order_by(Question.id)
+      #selection = Question.query.order_by(func.random())
+      ## * - - - - - -
+      rows, total_questions, next_cursor = paginate(request, selection, Question, QUESTIONS_PER_PAGE,
+        columns=[Question.id, Category.type], total=question_counters.total())
+      
+      if len(rows)==0:
+        abort(404)  
+      
+      current_questions = question_fragments([row.id for row in rows])
+      currentCategory = rows[0].type
          
     return jsonify({
       'success': True,
       'questions': current_questions,
-      'total_questions': len(questions),
+      'total_questions': total_questions,
+      'next_cursor': next_cursor,
       'categories': types,
       'currentCategory': currentCategory
     })
 
 
+  '''
+  Export: streams the question bank as NDJSON or CSV in id order. Rows come
+  from a server-side cursor in EXPORT_FETCH_SIZE chunks so memory stays flat;
+  ?min_id= (inclusive) resumes an export and ?category= narrows it.
+  '''
+  @app.route('/questions/export', methods=['GET'])
+  def export_questions():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+      abort(400)
+    category = request.args.get('category', None)
+    if category is not None and not category.isdigit():
+      abort(400)
+    min_id = request.args.get('min_id', None, type=int)
+    fetch_size = app.config.get('EXPORT_FETCH_SIZE', 1000)
+
+    selection = db.session.query(*Question.projection())
+    if category is not None:
+      selection = selection.filter(Question.category_id == int(category))
+    if min_id is not None:
+      selection = selection.filter(Question.id >= min_id)
+    rows = selection.order_by(Question.id).yield_per(fetch_size)
+
+    response = Response(stream_with_context(export_rows(rows, export_format, fetch_size)),
+      mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=questions.{}'.format(export_format)
+    return response
+
   '''
   @TODO: 
   Create an endpoint to DELETE question using a question ID. 
@@ -128,21 +346,57 @@ def create_app(test_config=None):
   @app.route('/questions/<int:question_id>', methods=['DELETE'])
   def delete_question(question_id):
     if request.method != 'DELETE': abort(405)    
+    if request.args.get('return') == 'minimal':
+      # skip the page reload: one DELETE and the total from the in-memory pools
+      if not Question.delete_many([question_id]):
+        abort(422)
+      return jsonify({
+        'success': True,
+        'deleted': question_id,
+        'total_questions': question_counters.total()
+      })
+
     try:
       question = Question.query.filter(Question.id == question_id).one_or_none()
       question.delete()
-      selection = Question.query.order_by(Question.id).all()
-      current_questions = paginate_questions(request, selection)
+      selection = Question.query.order_by(Question.id)
+      current_questions, total_questions, next_cursor = paginate_questions(request, selection, total=question_counters.total())
 
       return jsonify({
       'success': True,
       'deleted': question_id,
       'questions': current_questions,
-      'total_questions': len(Question.query.all())
+      'total_questions': total_questions,
+      'next_cursor': next_cursor
       })
     except:
       abort(422)
 
+  '''
+  Batch delete: DELETE /questions?ids=1,2,3 removes every listed question
+  in a single statement and transaction.
+  '''
+  @app.route('/questions', methods=['DELETE'])
+  def delete_questions():
+    try:
+      question_ids = [int(question_id) for question_id in request.args.get('ids', '').split(',') if question_id.strip()]
+    except ValueError:
+      abort(400)
+    if not question_ids or len(question_ids) > app.config.get('BULK_DELETE_MAX_IDS', 1000):
+      abort(400)
+
+    deleted = Question.delete_many(question_ids)
+    if not deleted:
+      abort(422)
+    not_found = sorted(set(question_ids) - set(deleted))
+
+    return jsonify({
+      'success': True,
+      'deleted': sorted(deleted),
+      'not_found': not_found,
+      'total_questions': question_counters.total()
+    })
+
   '''
   @TODO: 
   Create an endpoint to POST a new question, 
@@ -169,18 +423,60 @@ def create_app(test_config=None):
       # print(f'{Fore.WHITE}')
       question.insert()
       
-      questions = Question.query.order_by(Question.id).all()
-      current_questions = [question.format() for question in questions]
-      lastIndex = len(current_questions)-1
       return jsonify({
       'success': True,
       'created': question.id,
-      'question': current_questions[lastIndex],
-      'total_questions': len(Question.query.all())
+      'question': question.format(),
+      'total_questions': question_counters.total()
       })
     except:
       abort(422)
 
+  '''
+  Bulk ingestion: validates each row and inserts the valid ones in batches
+  of ?batch_size= (default BULK_INSERT_BATCH_SIZE), one transaction per batch.
+  '''
+  @app.route('/questions/bulk', methods=['POST'])
+  def create_questions_bulk():
+    batch_size = request.args.get('batch_size', app.config.get('BULK_INSERT_BATCH_SIZE', 500), type=int)
+    if batch_size < 1:
+      abort(400)
+    batch_size = min(batch_size, app.config.get('BULK_INSERT_MAX_BATCH_SIZE', 5000))
+
+    created = []
+    errors = []
+    batch = []
+
+    def flush():
+      rows = [row for index, row in batch]
+      try:
+        ids = Question.insert_many(rows)
+      except Exception as error:
+        db.session.rollback()
+        errors.extend({'index': index, 'message': 'insert failed: {}'.format(error.__class__.__name__)} for index, row in batch)
+      else:
+        created.extend({'index': index, 'id': question_id} for (index, row), question_id in zip(batch, ids))
+      del batch[:]
+
+    for index, body in enumerate(read_bulk_rows(request)):
+      row, message = validate_question(body)
+      if message is not None:
+        errors.append({'index': index, 'message': message})
+        continue
+      batch.append((index, row))
+      if len(batch) >= batch_size:
+        flush()
+    if batch:
+      flush()
+
+    return jsonify({
+      'success': True,
+      'created': created,
+      'errors': errors,
+      'total_created': len(created),
+      'total_errors': len(errors)
+    })
+
  ## ! ---------- OPTIONAL CREATE CATAGORY METHOD ----------DON'T TOUCH
 
   # @app.route('/categories', methods=['POST'])
@@ -214,24 +510,53 @@ def create_app(test_config=None):
   TEST: Search by any phrase. The questions list will update to include 
   only question that include that string within their question. 
   Try using the word "title" to start. 
+
+  The ids, total and cursor of each page are cached in search_cache by
+  lower-cased, whitespace-normalized term; the questions themselves come
+  from fragment_cache. Full-text results are ranked, not in id order, so
+  they have no ?after_id= cursor and are paged with ?page= only.
   '''
   
   @app.route('/questions/search', methods=['POST'])
+  @read_only
   def retrieve_searched_based_questions():
     if request.method != 'POST': abort(405)    
+    ranked = (request.get_json(silent=True) or {}).get('searchMode', app.config.get('SEARCH_DEFAULT_MODE', 'substring')) == FULLTEXT
+    if ranked and request.args.get('after_id') is not None:
+      abort(400)
     try:
       body = request.get_json()
       search = body.get('searchTerm', None)
-      selection = Question.query.filter(Question.question.ilike('%{}%'.format(search)))
-      current_questions = paginate_questions(request, selection)
+      mode = body.get('searchMode', app.config.get('SEARCH_DEFAULT_MODE', 'substring'))
+      if mode not in SEARCH_MODES:
+        abort(422)
+
+      search = normalize_term(search)
+      key = (search, mode, request.args.get('page', 1, type=int), request.args.get('after_id', None, type=int))
+      result = search_cache.get(key)
+      if result is None:
+        version = search_cache.version
+        if question_search.in_database(db.engine):
+          selection = question_search.selection(Question, search, mode)
+          rows, total_questions, next_cursor = paginate(request, selection, Question, QUESTIONS_PER_PAGE, columns=[Question.id])
+          result = ([row.id for row in rows], total_questions, next_cursor)
+        else:
+          result = page_of_ids(request, question_search.ids(search, mode))
+        if ranked:
+          # the last id of a ranked page says nothing about where the next one starts
+          result = result[:2] + (None,)
+        search_cache.put(key, result, version)
+      page_ids, total_questions, next_cursor = result
+      current_questions = question_fragments(page_ids)
       
-      if (len(selection.all()) !=0 and len(current_questions) == 0):
+      if (total_questions !=0 and len(current_questions) == 0):
         abort(404) 
       
       return jsonify({
         'success': True,
         'questions': current_questions,
-        'total_questions': len(selection.all()),
+        'total_questions': total_questions,
+        'next_cursor': next_cursor,
         'current_category': None 
       })
     except:
@@ -250,17 +575,22 @@ def create_app(test_config=None):
   '''
   #could also write this in the first questions get endpoint as a JSON body or as a Args request
   @app.route('/categories/<string:category_id>/questions', methods=['GET'])
+  @conditional('questions')
   def retrieve_category_based_questions(category_id):
     if request.method != 'GET': abort(405)
     
     #category_id= int(category_id)+1
-    selection = Question.query.filter(Question.category == category_id).order_by(Question.id).all()     
-    
-    if not len(selection): 
-      print(len(selection))
+    if not category_id.isdigit():
       abort(422)
+    snapshot = current_snapshot()
+    if snapshot is not None:
+      current_questions, total_questions, next_cursor, _ = paginate_snapshot(request, snapshot, category_id)
+    else:
+      selection = Question.query.filter(Question.category_id == int(category_id)).order_by(Question.id)
+      current_questions, total_questions, next_cursor = paginate_questions(request, selection, total=question_counters.count(category_id))
     
-    current_questions = paginate_questions(request, selection)
+    if not total_questions: 
+      abort(422)
     
     if len(current_questions) == 0:
       abort(404)  
@@ -268,8 +598,9 @@ def create_app(test_config=None):
     return jsonify({
       'success': True,
       'questions': current_questions,
-      'total_questions': len(selection),
-      'current_category': selection[0].category
+      'total_questions': total_questions,
+      'next_cursor': next_cursor,
+      'current_category': category_id
     })
     
 
@@ -283,9 +614,15 @@ def create_app(test_config=None):
   TEST: In the "Play" tab, after a user selects "All" or a category,
   one question at a time is displayed, the user is allowed to answer
   and shown whether they were correct or not. 
+
+  Optional difficulty settings (see read_difficulty_plan) weight the draw
+  towards a target difficulty or along a curve; with `adaptive` the target
+  follows the `answers` the client reports. `count` prefetches up to that
+  many distinct questions (at most QUIZ_MAX_COUNT) in one call.
   '''
   
   @app.route('/questions/quiz', methods=['POST'])
+  @read_only
   def retrieve_quiz_questions():
     
     if request.method != 'POST': abort(405)
@@ -294,30 +631,229 @@ def create_app(test_config=None):
     previous_questions = body.get('previous_questions', [])
     category= body.get('quiz_category' , {"type": "click", "id" : 0})
     #print('PQ: ', previous_questions, 'C: ', category) #! Troubleshooting code
+    plan, error = read_difficulty_plan(body)
+    if error:
+      abort(400)
+    curve = plan.curve if plan is not None else None
+    count = body.get('count', 1)
+    if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+      abort(400)
+    count = min(count, app.config.get('QUIZ_MAX_COUNT', 50))
     
 
-    if category["id"] == 0:
-      questions = Question.query.filter(Question.id.notin_(q for q in previous_questions)).order_by(func.random()).all()
-    else: 
-      questions = Question.query.filter(and_(Question.category == category["id"], Question.id.notin_(q for q in previous_questions))).order_by(func.random()).all()
-    
-    if len(questions) == 0: 
-      question = 0
-    if len(questions) == 0 and len(previous_questions) == 0:
+    questions = RawJSONArray()
+    total_questions = None
+    snapshot = current_snapshot()
+    if snapshot is not None:
+      drawn, total_questions = snapshot.draw_many(category["id"], previous_questions, count, curve)
+      for question_id, fragment in drawn:
+        questions.append(RawJSON(fragment))
+        previous_questions.append(question_id)
+    # otherwise draw ids from the in-memory pools and fetch only the chosen rows,
+    # in one query; ids deleted by another worker are dropped from the pool and redrawn
+    while snapshot is None and len(questions) < count:
+      question_ids, remaining = question_sampler.draw_many(category["id"], previous_questions, count - len(questions), curve)
+      if total_questions is None:
+        total_questions = remaining
+      if not question_ids:
+        break
+      found = fetch_fragments(question_ids)
+      for question_id in question_ids:
+        if question_id in found:
+          questions.append(RawJSON(found[question_id]))
+          previous_questions.append(question_id)
+        else:
+          question_sampler.remove(question_id)
+          total_questions -= 1
+
+    if total_questions == 0 and len(previous_questions) == 0:
       abort(422)
-    if len(questions):
-      #print('questions before format: ' , questions, 'length of questions: ', len(questions)) #! Troubleshooting code
-      question = questions[0].format()
-      #print('length of question', len(question), ' question contents: ' , question, ' question ID: ' , question['id']) #! Troubleshooting code
-      previous_questions.append(question['id'])
       
+    result = {
+      'success': True,
+      'question': questions[0] if questions else 0,
+      'previous_questions':previous_questions,
+      'total_questions': total_questions
+    }
+    if 'count' in body:
+      result['questions'] = questions
+    if plan is not None:
+      result.update(plan.format())
+    return jsonify(result)
+
+  '''
+  Quiz sessions: the server keeps a shuffled deck of question ids per session
+  so the client only sends a token instead of the growing previous_questions list.
+  Sessions created with difficulty settings draw each question by difficulty
+  instead, and adaptive ones take the answer to the previous question as
+  `correct` in the body of the next call. Sessions live in this worker's
+  memory, so a multi-worker deployment needs sticky routing per token.
+  '''
+  quiz_sessions = QuizSessionStore(
+    max_sessions=app.config.get('QUIZ_SESSION_LIMIT', 10000),
+    ttl=app.config.get('QUIZ_SESSION_TTL', 1800))
+
+  @app.route('/quizzes', methods=['POST'])
+  @read_only
+  def create_quiz_session():
+    body = request.get_json() or {}
+    category = body.get('quiz_category', {"type": "click", "id" : 0})
+    try:
+      category_id = category["id"]
+    except (KeyError, TypeError):
+      abort(400)
+
+    plan, error = read_difficulty_plan(body)
+    if error:
+      abort(400)
+
+    snapshot = current_snapshot()
+    if plan is not None:
+      # only questions at positively weighted difficulties can be drawn
+      total_questions = (snapshot.count(category_id, plan.curve) if snapshot is not None
+        else question_sampler.count(category_id, plan.curve))
+      if total_questions == 0:
+        abort(422)
+      session = quiz_sessions.create_weighted(category_id, total_questions, plan)
+    else:
+      question_ids = snapshot.ids(category_id) if snapshot is not None else question_sampler.ids(category_id)
+      if len(question_ids) == 0:
+        abort(422)
+      session = quiz_sessions.create(category_id, question_ids)
+      total_questions = len(question_ids)
+
+    result = {
+      'success': True,
+      'token': session.token,
+      'total_questions': total_questions
+    }
+    if plan is not None:
+      result.update(plan.format())
+    return jsonify(result)
+
+  @app.route('/quizzes/<string:token>/next', methods=['POST'])
+  @read_only
+  def next_quiz_question(token):
+    session = quiz_sessions.get(token)
+    if session is None:
+      abort(404)
+    if isinstance(session, WeightedQuizSession):
+      return next_weighted_question(session)
+
+    question = 0
+    total_questions = len(session.deck)
+    snapshot = current_snapshot()
+    # ids deleted since the deck was dealt are skipped
+    while True:
+      question_id = session.next()
+      if question_id is None:
+        break
+      if snapshot is not None:
+        fragment = snapshot.fragment(question_id)
+        fragments = [fragment] if fragment is not None else []
+      else:
+        fragments = question_fragments([question_id])
+      if fragments:
+        question = RawJSON(fragments[0])
+        break
+
     return jsonify({
       'success': True,
       'question': question,
-      'previous_questions':previous_questions,
-      'total_questions': len(questions)
+      'total_questions': total_questions,
+      'remaining': len(session.deck)
+    })
+
+  def next_weighted_question(session):
+    body = request.get_json(silent=True) or {}
+    correct = body.get('correct')
+    if correct is not None:
+      if not isinstance(correct, bool):
+        abort(400)
+      session.plan.record(correct)
+
+    question = 0
+    snapshot = current_snapshot()
+    while True:
+      if snapshot is not None:
+        question_id, fragment, total_questions = snapshot.draw(session.category, session.seen, session.plan.curve)
+        fragments = [fragment] if question_id is not None else []
+      else:
+        question_id, total_questions = question_sampler.draw(session.category, session.seen, session.plan.curve)
+        fragments = question_fragments([question_id]) if question_id is not None else []
+      if question_id is None:
+        break
+      if fragments:
+        question = RawJSON(fragments[0])
+        session.served_question(question_id)
+        break
+      # deleted by another worker since the pools were loaded
+      question_sampler.remove(question_id)
+
+    return jsonify(dict({
+      'success': True,
+      'question': question,
+      'total_questions': total_questions,
+      'remaining': total_questions - 1 if question else 0
+    }, **session.plan.format()))
+
+  @app.route('/quizzes/<string:token>', methods=['DELETE'])
+  def delete_quiz_session(token):
+    if not quiz_sessions.discard(token):
+      abort(404)
+    return jsonify({
+      'success': True,
+      'deleted': token
+    })
+
+  '''
+  Stats: question counts overall, per category and per difficulty, served
+  from the maintained counters rather than a table scan.
+  '''
+  @app.route('/stats', methods=['GET'])
+  def retrieve_stats():
+    histogram = question_counters.histogram()
+    types = category_cache.types()
+    categories = {}
+    for category_id, category_type in types.items():
+      difficulties = histogram.get(str(category_id), {})
+      categories[category_id] = {
+        'type': category_type,
+        'total_questions': sum(difficulties.values()),
+        'difficulty': difficulties
+      }
+
+    return jsonify({
+      'success': True,
+      'total_questions': question_counters.total(),
+      'total_categories': len(types),
+      'categories': categories,
+      'reconciled_at': question_counters.reconciled_at,
+      'last_drift': question_counters.last_drift
     })
 
+  @app.cli.command('init-db')
+  def init_db():
+    """Create the tables and search indexes; safe to run on every deploy."""
+    init_schema()
+    print('database schema ready')
+
+  @app.cli.command('export-snapshot')
+  def export_question_snapshot():
+    """Write the question bank snapshot to SNAPSHOT_PATH for the workers to map."""
+    store = snapshot_for(app)
+    if store is None:
+      print('SNAPSHOT_PATH is not configured')
+      return
+    snapshot = store.rebuild()
+    print('question snapshot written to {} ({} questions)'.format(store.path, snapshot.count()))
+
+  @app.cli.command('reconcile-counters')
+  def reconcile_counters():
+    """Recount questions per category and difficulty and report the drift."""
+    drift = question_counters.reconcile()
+    print('question counters reconciled, drift {:+d}'.format(drift))
+
   '''
   @TODO: 
   Create error handlers for all expected errors 
@@ -354,6 +890,9 @@ def create_app(test_config=None):
       "error": 400,
       "message": "bad request"
       }), 400
+
+  init_admission(app)
+  init_lifecycle(app, started)
   return app
 
   @app.errorhandler(500)
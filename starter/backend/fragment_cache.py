@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+'''
+FragmentCache
+    LRU cache of encoded JSON fragments (bytes) keyed by row id, bounded by
+    `max_bytes` of fragment data. Entries older than `max_age` seconds are
+    treated as misses so updates made by other worker processes show up.
+    discard() bumps a generation counter; put() calls that started before an
+    invalidation pass the generation they read and are ignored, so a reader
+    racing a writer cannot re-insert the stale row.
+'''
+class FragmentCache:
+
+  def __init__(self, max_bytes=32 * 1024 * 1024, max_age=300):
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self._entries = OrderedDict()
+    self._bytes = 0
+    self._generation = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  @property
+  def generation(self):
+    return self._generation
+
+  def get_many(self, keys):
+    '''
+    returns ({key: fragment} for the cached keys, [keys that missed])
+    '''
+    found = {}
+    missing = []
+    now = time.time()
+    with self._lock:
+      for key in keys:
+        entry = self._entries.get(key)
+        if entry is None or now - entry[1] >= self.max_age:
+          missing.append(key)
+          continue
+        self._entries.move_to_end(key)
+        found[key] = entry[0]
+      self.hits += len(found)
+      self.misses += len(missing)
+    return found, missing
+
+  def put(self, key, fragment, generation=None):
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return
+      if len(fragment) > self.max_bytes:
+        return
+      self._remove(key)
+      self._entries[key] = (fragment, time.time())
+      self._bytes += len(fragment)
+      while self._bytes > self.max_bytes:
+        oldest, (evicted, stored_at) = self._entries.popitem(last=False)
+        self._bytes -= len(evicted)
+        self.evictions += 1
+
+  def _remove(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._bytes -= len(entry[0])
+    return entry
+
+  def discard(self, key):
+    with self._lock:
+      self._generation += 1
+      if self._remove(key) is not None:
+        self.invalidations += 1
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self._entries),
+        'bytes': self._bytes,
+        'max_bytes': self.max_bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations
+      }
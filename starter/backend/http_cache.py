@@ -0,0 +1,67 @@
+import functools
+import hashlib
+import os
+import time
+
+from flask import current_app, make_response, request
+
+from compression import cached_response, compress_response, negotiated_encoding, representation_tag
+from versions import table_versions
+
+DEFAULT_CACHE_CONTROL = 'no-cache'
+DEFAULT_ETAG_WINDOW = 300
+
+# table versions are per process, so tags from different workers must never collide
+PROCESS_EPOCH = '{}-{}'.format(os.getpid(), os.urandom(4).hex())
+
+'''
+compute_etag(tables)
+    strong entity tag for the current GET request built from the versions of
+    the tables the response is derived from plus the path and query args.
+    The tag also rolls over every ETAG_WINDOW seconds, which bounds how long
+    a worker can keep confirming a tag after another worker wrote the table.
+'''
+def compute_etag(tables):
+  window = current_app.config.get('ETAG_WINDOW', DEFAULT_ETAG_WINDOW)
+  parts = [PROCESS_EPOCH, str(int(time.time() // window)) if window else '0']
+  parts.extend('{}={}'.format(table, table_versions.get(table)) for table in tables)
+  parts.append(request.full_path)
+  return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def cache_control_for(endpoint):
+  per_route = current_app.config.get('CACHE_CONTROL', {})
+  return per_route.get(endpoint, current_app.config.get('CACHE_CONTROL_DEFAULT', DEFAULT_CACHE_CONTROL))
+
+'''
+conditional(*tables)
+    decorator for GET views. Answers 304 Not Modified when If-None-Match
+    carries the current tag (the view is never called), otherwise tags the
+    200 response with ETag and the route's Cache-Control header. Each content
+    coding gets its own tag, and a compressed body is reused from the
+    compressed cache while the tag stays the same.
+'''
+def conditional(*tables):
+  def decorator(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+      if request.method != 'GET':
+        return view(*args, **kwargs)
+
+      encoding = negotiated_encoding()
+      etag = compute_etag(tables)
+      tag = representation_tag(etag, encoding)
+      cache_control = cache_control_for(request.endpoint)
+      if request.if_none_match.contains(tag):
+        response = make_response('', 304)
+      else:
+        response = cached_response(etag, encoding)
+        if response is None:
+          response = make_response(view(*args, **kwargs))
+          if response.status_code != 200:
+            return response
+          compress_response(response, encoding, etag)
+      response.set_etag(tag)
+      response.headers['Cache-Control'] = cache_control
+      return response
+    return wrapper
+  return decorator
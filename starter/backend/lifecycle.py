@@ -0,0 +1,68 @@
+import logging
+import os
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+from metrics import registry
+
+boot_log = logging.getLogger('trivia.boot')
+
+BOOT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_started = {'pid': os.getpid(), 'at': time.perf_counter(), 'forked': False}
+_ready_pid = None
+
+def _after_fork():
+  _started.update(pid=os.getpid(), at=time.perf_counter(), forked=True)
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork)
+
+'''
+fork safety
+    every pooled connection remembers the process that opened it. A worker
+    forked from a master that had already connected (e.g. gunicorn --preload)
+    refuses those inherited connections on checkout and opens its own, so no
+    two processes ever talk over the same socket. This covers every engine,
+    including the replicas, because the events are registered on Pool.
+'''
+@event.listens_for(Pool, 'connect')
+def _remember_owner(dbapi_connection, connection_record):
+  connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def _refuse_inherited(dbapi_connection, connection_record, connection_proxy):
+  pid = os.getpid()
+  owner = connection_record.info.get('pid', pid)
+  if owner != pid:
+    # drop the connection without closing it: closing would also end the
+    # session the parent process is still using
+    connection_record.connection = connection_proxy.connection = None
+    raise exc.DisconnectionError('connection opened by process {} checked out in {}'.format(owner, pid))
+
+def _report(phase, seconds):
+  registry.observe('trivia_boot_seconds', (('phase', phase),), seconds, BOOT_BUCKETS)
+  boot_log.info('%s ready in %.1f ms (pid %d)', phase, seconds * 1000, os.getpid())
+
+'''
+init_lifecycle(app, started)
+    reports boot times to the 'trivia.boot' logger and as the
+    trivia_boot_seconds histogram: phase="create_app" is the app factory
+    (timed from `started`), phase="worker" runs from process start or fork
+    to the first request the process serves.
+'''
+def init_lifecycle(app, started):
+  _report('create_app', time.perf_counter() - started)
+
+  @app.before_request
+  def report_worker_ready():
+    global _ready_pid
+    if _ready_pid == os.getpid():
+      return
+    _ready_pid = os.getpid()
+    if _started['pid'] != _ready_pid:
+      # forked without register_at_fork; time from the first request instead
+      _after_fork()
+    _report('worker', time.perf_counter() - _started['at'])
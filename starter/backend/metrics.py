@@ -0,0 +1,244 @@
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Response, g, request
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS = {
+  'trivia_http_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+  'trivia_http_request_duration_seconds': ('histogram', 'HTTP request latency by route and method.'),
+  'trivia_db_pool_checkout_wait_seconds': ('histogram', 'Time spent waiting to check a connection out of the pool.'),
+  'trivia_cache_requests_total': ('counter', 'Cache lookups by cache and result.'),
+  'trivia_cache_evictions_total': ('counter', 'Entries evicted from a cache.'),
+  'trivia_boot_seconds': ('histogram', 'App factory and worker start-up time by phase.'),
+  'trivia_admission_requests_total': ('counter', 'Admission decisions by route and result (admitted, throttled, overloaded).'),
+  'trivia_admission_in_flight': ('gauge', 'Requests in flight on routes with a concurrency limit.'),
+}
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + '}'
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+'''
+MetricsRegistry
+    counters and histograms for one process. Collectors are callables run at
+    scrape time that return extra (name, labels, value) samples, e.g. cache
+    statistics; samples of metrics declared as gauges in METRICS are kept
+    apart from the counters. Registering the same key again replaces the
+    collector. snapshot() gives a JSON-able copy that can be summed with the
+    snapshots of other worker processes before rendering.
+'''
+class MetricsRegistry:
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+    self._collectors = {}
+
+  def inc(self, name, labels=(), value=1):
+    key = (name, tuple(labels))
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def observe(self, name, labels=(), value=0.0, buckets=LATENCY_BUCKETS):
+    key = (name, tuple(labels))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+      for index, bound in enumerate(histogram['buckets']):
+        if value <= bound:
+          histogram['counts'][index] += 1
+      histogram['sum'] += value
+      histogram['count'] += 1
+
+  def register_collector(self, key, collector):
+    self._collectors[key] = collector
+
+  def snapshot(self):
+    with self._lock:
+      counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+      histograms = [[name, list(labels), dict(histogram, counts=list(histogram['counts']))]
+        for (name, labels), histogram in self._histograms.items()]
+    gauges = []
+    for collector in list(self._collectors.values()):
+      for name, labels, value in collector():
+        samples = gauges if METRICS.get(name, ('counter',))[0] == 'gauge' else counters
+        samples.append([name, list(labels), value])
+    return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+def merge_snapshots(snapshots):
+  counters = {}
+  histograms = {}
+  for snapshot in snapshots:
+    for name, labels, value in snapshot['counters'] + snapshot.get('gauges', []):
+      key = (name, tuple(tuple(label) for label in labels))
+      counters[key] = counters.get(key, 0) + value
+    for name, labels, histogram in snapshot['histograms']:
+      key = (name, tuple(tuple(label) for label in labels))
+      merged = histograms.get(key)
+      if merged is None:
+        histograms[key] = dict(histogram, counts=list(histogram['counts']))
+        continue
+      merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+      merged['sum'] += histogram['sum']
+      merged['count'] += histogram['count']
+  return counters, histograms
+
+def render(snapshots):
+  '''
+  Prometheus text exposition of the summed snapshots
+  '''
+  counters, histograms = merge_snapshots(snapshots)
+  lines = []
+  for name, (kind, help_text) in METRICS.items():
+    samples = sorted((labels, value) for (metric, labels), value in counters.items() if metric == name)
+    series = sorted((labels, histogram) for (metric, labels), histogram in histograms.items() if metric == name)
+    if not samples and not series:
+      continue
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} {}'.format(name, kind))
+    for labels, value in samples:
+      lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+    for labels, histogram in series:
+      for bound, count in zip(histogram['buckets'], histogram['counts']):
+        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', _format_value(float(bound))),)), count))
+      lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+      lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(histogram['sum'])))
+      lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram['count']))
+  return '\n'.join(lines) + '\n'
+
+'''
+SnapshotDirectory
+    multi-process mode: every worker writes its snapshot to
+    <path>/metrics_<pid>.json (atomically, at most every `interval` seconds)
+    and a scrape on any worker sums all of the files. Files of exited workers
+    are kept so their counts are not lost, but their gauges are skipped since
+    they describe a process that is gone; clear the directory on deploy.
+'''
+class SnapshotDirectory:
+
+  def __init__(self, path, interval=1.0):
+    self.path = path
+    self.interval = interval
+    self._written_at = 0.0
+    os.makedirs(path, exist_ok=True)
+
+  def own_file(self):
+    return os.path.join(self.path, 'metrics_{}.json'.format(os.getpid()))
+
+  def write(self, registry, force=False):
+    now = time.time()
+    if not force and now - self._written_at < self.interval:
+      return
+    self._written_at = now
+    target = self.own_file()
+    temporary = '{}.{}.tmp'.format(target, threading.get_ident())
+    with open(temporary, 'w') as handle:
+      json.dump(registry.snapshot(), handle)
+    os.replace(temporary, target)
+
+  def read_all(self):
+    snapshots = []
+    for path in glob.glob(os.path.join(self.path, 'metrics_*.json')):
+      try:
+        with open(path) as handle:
+          snapshot = json.load(handle)
+      except (OSError, ValueError):
+        continue
+      if not _is_running(os.path.basename(path)[len('metrics_'):-len('.json')]):
+        snapshot.pop('gauges', None)
+      snapshots.append(snapshot)
+    return snapshots
+
+def _is_running(pid):
+  try:
+    os.kill(int(pid), 0)
+  except PermissionError:
+    return True
+  except (OSError, ValueError):
+    return False
+  return True
+
+registry = MetricsRegistry()
+
+'''
+TimedQueuePool
+    QueuePool that records how long each checkout waited for a connection
+'''
+class TimedQueuePool(QueuePool):
+
+  def _do_get(self):
+    started = time.perf_counter()
+    try:
+      return QueuePool._do_get(self)
+    finally:
+      registry.observe('trivia_db_pool_checkout_wait_seconds', (), time.perf_counter() - started, POOL_WAIT_BUCKETS)
+
+def cache_collector(name, cache):
+  '''
+  collector reporting hits/misses/evictions of a cache with those attributes
+  '''
+  def collect():
+    yield 'trivia_cache_requests_total', (('cache', name), ('result', 'hit')), cache.hits
+    yield 'trivia_cache_requests_total', (('cache', name), ('result', 'miss')), cache.misses
+    yield 'trivia_cache_evictions_total', (('cache', name),), cache.evictions
+  return collect
+
+'''
+init_metrics(app)
+    records request counts and latency per route and serves /metrics.
+    METRICS_DIR switches to the multi-process SnapshotDirectory mode,
+    with METRICS_FLUSH_SECONDS between snapshot writes. Snapshots are written
+    on teardown, so call this before init_admission: teardown functions run
+    in reverse order and the snapshot then sees the admission slot released.
+'''
+def init_metrics(app):
+  directory = None
+  if app.config.get('METRICS_DIR'):
+    directory = SnapshotDirectory(app.config['METRICS_DIR'], app.config.get('METRICS_FLUSH_SECONDS', 1.0))
+
+  @app.before_request
+  def start_timer():
+    g.metrics_started = time.perf_counter()
+
+  @app.after_request
+  def record_request(response):
+    started = g.get('metrics_started')
+    if started is None:
+      return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    registry.inc('trivia_http_requests_total', (('route', route), ('method', request.method), ('status', str(response.status_code))))
+    registry.observe('trivia_http_request_duration_seconds', (('route', route), ('method', request.method)), time.perf_counter() - started)
+    return response
+
+  @app.teardown_request
+  def write_snapshot(error):
+    if directory is not None and g.get('metrics_started') is not None:
+      directory.write(registry)
+
+  @app.route('/metrics', methods=['GET'])
+  def metrics():
+    if directory is None:
+      snapshots = [registry.snapshot()]
+    else:
+      directory.write(registry, force=True)
+      snapshots = directory.read_all()
+    return Response(render(snapshots), content_type=CONTENT_TYPE)
@@ -0,0 +1,125 @@
+"""questions.category_id: add the integer category column, backfill and index it
+
+Expand half of replacing the unindexed questions.category with an indexed
+integer foreign key; 0003 contracts. Until 0003 runs both columns are kept
+in step (by a trigger on Postgres), so the previous release and the new one
+can serve side by side during a rolling deploy:
+
+    flask db upgrade 0002    # online: column, trigger, batched backfill,
+                             # CREATE INDEX CONCURRENTLY
+    (deploy the new release)
+    flask db upgrade         # 0003: validate, NOT NULL, drop the old column
+
+The backfill commits every `-x backfill_batch=N` rows (default 10000) on
+Postgres so it never holds long row locks on a large table.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:10:00.000000
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+DEFAULT_BACKFILL_BATCH = 10000
+
+# trivia.psql declares questions.category as integer, create_all as varchar;
+# comparing as text works for both
+BACKFILL_BATCH = sa.text(
+    'UPDATE questions SET category_id = ('
+    'SELECT categories.id FROM categories '
+    'WHERE CAST(categories.id AS VARCHAR) = CAST(questions.category AS VARCHAR)) '
+    'WHERE id > :low AND id <= :high AND category_id IS NULL')
+NEXT_BATCH_END = sa.text(
+    'SELECT max(id) FROM (SELECT id FROM questions WHERE id > :low ORDER BY id LIMIT :size) AS batch')
+
+SYNC_FUNCTION = """
+CREATE OR REPLACE FUNCTION questions_sync_category() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    IF NEW.category_id IS NULL THEN
+      NEW.category_id := NEW.category::integer;
+    ELSIF NEW.category IS NULL THEN
+      NEW.category := NEW.category_id;
+    END IF;
+  ELSIF NEW.category IS DISTINCT FROM OLD.category THEN
+    NEW.category_id := NEW.category::integer;
+  ELSIF NEW.category_id IS DISTINCT FROM OLD.category_id THEN
+    NEW.category := NEW.category_id;
+  END IF;
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+SYNC_TRIGGER = ('CREATE TRIGGER questions_sync_category BEFORE INSERT OR UPDATE ON questions '
+                'FOR EACH ROW EXECUTE PROCEDURE questions_sync_category()')
+
+INDEXES = (
+    ('ix_questions_category_id_id', ['category_id', 'id']),
+    ('ix_questions_difficulty', ['difficulty'])
+)
+
+
+def backfill(connection, batch_size):
+    low = 0
+    while True:
+        high = connection.execute(NEXT_BATCH_END, low=low, size=batch_size).scalar()
+        if high is None:
+            return
+        connection.execute(BACKFILL_BATCH, low=low, high=high)
+        low = high
+
+
+def upgrade():
+    connection = op.get_bind()
+    batch_size = int(context.get_x_argument(as_dictionary=True).get('backfill_batch', DEFAULT_BACKFILL_BATCH))
+
+    if connection.dialect.name != 'postgresql':
+        # SQLite rebuilds the table to relax NOT NULL; there is no online path to keep
+        with op.batch_alter_table('questions') as batch:
+            batch.alter_column('category', existing_type=sa.String(), nullable=True)
+            batch.add_column(sa.Column('category_id', sa.Integer(), nullable=True))
+        backfill(connection, batch_size)
+        for name, columns in INDEXES:
+            op.create_index(name, 'questions', columns)
+        return
+
+    # metadata-only changes, committed before the backfill starts
+    op.add_column('questions', sa.Column('category_id', sa.Integer(), nullable=True))
+    op.alter_column('questions', 'category', nullable=True)
+    op.execute('ALTER TABLE questions ADD CONSTRAINT fk_questions_category_id '
+               'FOREIGN KEY (category_id) REFERENCES categories (id) NOT VALID')
+    op.execute(SYNC_FUNCTION)
+    op.execute(SYNC_TRIGGER)
+
+    with op.get_context().autocommit_block():
+        backfill(connection, batch_size)
+        for name, columns in INDEXES:
+            op.create_index(name, 'questions', columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    connection = op.get_bind()
+    for name, columns in INDEXES:
+        op.drop_index(name, table_name='questions')
+    # rows written by the new release only carry category_id
+    connection.execute(sa.text('UPDATE questions SET category = category_id WHERE category IS NULL'))
+
+    if connection.dialect.name != 'postgresql':
+        with op.batch_alter_table('questions') as batch:
+            batch.drop_column('category_id')
+            batch.alter_column('category', existing_type=sa.String(), nullable=False)
+        return
+
+    op.execute('DROP TRIGGER questions_sync_category ON questions')
+    op.execute('DROP FUNCTION questions_sync_category()')
+    op.drop_constraint('fk_questions_category_id', 'questions', type_='foreignkey')
+    op.drop_column('questions', 'category_id')
+    op.alter_column('questions', 'category', nullable=False)
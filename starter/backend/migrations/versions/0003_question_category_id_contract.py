@@ -0,0 +1,93 @@
+"""questions.category_id: make it NOT NULL and the foreign key, drop questions.category
+
+Contract half of 0002. Run it once no process of the previous release is
+left writing questions.category.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+# rows the previous release wrote after the 0002 backfill (SQLite has no sync trigger)
+BACKFILL_REMAINING = sa.text(
+    'UPDATE questions SET category_id = ('
+    'SELECT categories.id FROM categories '
+    'WHERE CAST(categories.id AS VARCHAR) = CAST(questions.category AS VARCHAR)) '
+    'WHERE category_id IS NULL')
+
+SYNC_FUNCTION = """
+CREATE OR REPLACE FUNCTION questions_sync_category() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    IF NEW.category_id IS NULL THEN
+      NEW.category_id := NEW.category::integer;
+    ELSIF NEW.category IS NULL THEN
+      NEW.category := NEW.category_id;
+    END IF;
+  ELSIF NEW.category IS DISTINCT FROM OLD.category THEN
+    NEW.category_id := NEW.category::integer;
+  ELSIF NEW.category_id IS DISTINCT FROM OLD.category_id THEN
+    NEW.category := NEW.category_id;
+  END IF;
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+SYNC_TRIGGER = ('CREATE TRIGGER questions_sync_category BEFORE INSERT OR UPDATE ON questions '
+                'FOR EACH ROW EXECUTE PROCEDURE questions_sync_category()')
+
+
+def upgrade():
+    connection = op.get_bind()
+    connection.execute(BACKFILL_REMAINING)
+    orphans = connection.execute(sa.text('SELECT count(*) FROM questions WHERE category_id IS NULL')).scalar()
+    if orphans:
+        raise RuntimeError('{} questions reference a category that does not exist; '
+                           'fix or delete them and upgrade again'.format(orphans))
+
+    if connection.dialect.name != 'postgresql':
+        with op.batch_alter_table('questions') as batch:
+            batch.alter_column('category_id', existing_type=sa.Integer(), nullable=False)
+            batch.create_foreign_key('fk_questions_category_id', 'categories', ['category_id'], ['id'])
+            batch.drop_column('category')
+        return
+
+    # VALIDATE only takes a SHARE UPDATE EXCLUSIVE lock, and with a validated
+    # CHECK in place Postgres 12+ sets NOT NULL without scanning the table again
+    op.execute('ALTER TABLE questions VALIDATE CONSTRAINT fk_questions_category_id')
+    op.execute('ALTER TABLE questions ADD CONSTRAINT ck_questions_category_id_not_null '
+               'CHECK (category_id IS NOT NULL) NOT VALID')
+    op.execute('ALTER TABLE questions VALIDATE CONSTRAINT ck_questions_category_id_not_null')
+    op.alter_column('questions', 'category_id', existing_type=sa.Integer(), nullable=False)
+    op.drop_constraint('ck_questions_category_id_not_null', 'questions', type_='check')
+    op.execute('DROP TRIGGER questions_sync_category ON questions')
+    op.execute('DROP FUNCTION questions_sync_category()')
+    op.drop_column('questions', 'category')
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name != 'postgresql':
+        with op.batch_alter_table('questions') as batch:
+            batch.add_column(sa.Column('category', sa.String(), nullable=True))
+        connection.execute(sa.text('UPDATE questions SET category = category_id'))
+        with op.batch_alter_table('questions') as batch:
+            batch.drop_constraint('fk_questions_category_id', type_='foreignkey')
+            batch.alter_column('category_id', existing_type=sa.Integer(), nullable=True)
+        return
+
+    op.add_column('questions', sa.Column('category', sa.String(), nullable=True))
+    connection.execute(sa.text('UPDATE questions SET category = category_id'))
+    op.alter_column('questions', 'category_id', existing_type=sa.Integer(), nullable=True)
+    op.execute(SYNC_FUNCTION)
+    op.execute(SYNC_TRIGGER)
@@ -1,27 +1,84 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine, inspect
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, stamp, upgrade
+from sqlalchemy import orm
 import json
 
+from sampler import QuestionSampler
+from search import QuestionSearch
+from category_cache import CategoryCache
+from versions import table_versions
+from routing import RoutingSession, init_replicas, engine_options
+from fragment_cache import FragmentCache
+from search_cache import SearchResultCache
+from counters import QuestionCounters
+from profiling import ProfilingQuery
+from snapshot import init_snapshot, snapshot_for, write_snapshot
+from serialization import dumps
+from sqlalchemy import func
+from flask import current_app, has_app_context
+
 database_name = "trivia"
 database_path = "postgresql+psycopg2://{}:{}@{}/{}".format('postgres', '1','localhost:5432', database_name)
 
-db = SQLAlchemy()
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# the schema of trivia.psql and of databases created before migrations existed
+BASELINE_REVISION = '0001'
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy(query_class=ProfilingQuery)
+migrate = Migrate(directory=MIGRATIONS_DIR)
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    Writes always go to database_path. Reads made while serving GET (and
+    @read_only) requests go to one of replica_paths, or the
+    SQLALCHEMY_REPLICA_URIS config list, when given. Pool settings (pool_size,
+    max_overflow, pool_pre_ping, pool_recycle, pool_timeout) come from
+    SQLALCHEMY_PRIMARY_POOL and SQLALCHEMY_REPLICA_POOL; READ_YOUR_WRITES_SECONDS
+    pins a client to the primary for that long after it writes.
+    SNAPSHOT_PATH enables the shared question-bank snapshot (see snapshot.py).
+    Nothing connects here: engines are created on first use and the schema
+    comes from init_schema().
+'''
+def setup_db(app, database_path=database_path, replica_paths=None):
+  app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+  app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+  app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path, app.config.get("SQLALCHEMY_PRIMARY_POOL"))
+  if replica_paths is None:
+    replica_paths = app.config.get("SQLALCHEMY_REPLICA_URIS", [])
+  init_replicas(app, replica_paths, app.config.get("SQLALCHEMY_REPLICA_POOL"), app.config.get("READ_YOUR_WRITES_SECONDS", 0))
+  db.app = app
+  db.init_app(app)
+  migrate.init_app(app, db)
+  fragment_cache.max_bytes = app.config.get("FRAGMENT_CACHE_BYTES", fragment_cache.max_bytes)
+  search_cache.max_entries = app.config.get("SEARCH_CACHE_ENTRIES", search_cache.max_entries)
+  question_counters.interval = app.config.get("COUNTERS_RECONCILE_SECONDS", question_counters.interval)
+  init_snapshot(app, app.config.get("SNAPSHOT_PATH"), export_snapshot, app.config.get("SNAPSHOT_CHECK_SECONDS", 1.0),
+    app.config.get("SNAPSHOT_EXPORT_SECONDS", 5.0))
+  reset_caches()
+  return True
+
+'''
+init_schema()
+    upgrades the database to the newest migration (see migrations/) and
+    creates the search indexes. A database loaded from trivia.psql, or
+    created before migrations existed, is stamped with the baseline revision
+    first. setup_db never touches the database (engines connect on first
+    use), so run this once per deploy with `flask init-db` instead of on
+    every app or worker start.
 '''
-def setup_db(app, database_path=database_path):
-  try:
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
-    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
-    db.init_app(app)
-    db.create_all()
-    return True
-  except:
-    return False
+def init_schema():
+  tables = inspect(db.engine).get_table_names()
+  if 'questions' in tables and 'alembic_version' not in tables:
+    stamp(revision=BASELINE_REVISION)
+  upgrade()
+  question_search.ensure_indexes(db.engine)
 
 '''
 Question
@@ -29,40 +86,200 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # category listings and the keyset seek within a category read this index in order
+  __table_args__ = (Index('ix_questions_category_id_id', 'category_id', 'id'),)
 
   id = Column(Integer, primary_key=True)
   question = Column(String, nullable=False)
   answer = Column(String, nullable=False)
-  category = Column(String, nullable=False)
-  difficulty = Column(Integer, default = 1)
+  category_id = Column(Integer, ForeignKey('categories.id', name='fk_questions_category_id'), nullable=False)
+  difficulty = Column(Integer, default = 1, index=True)
+
+  # the API keeps calling the category id `category`
+  category = orm.synonym('category_id')
+
+  format_columns = ('id', 'question', 'answer', 'category', 'difficulty')
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
-    self.category = category
+    self.category_id = int(category)
     self.difficulty = difficulty
 
   def insert(self):
     db.session.add(self)
     db.session.commit()
+    questions_written([(self.id, self.category_id, self.difficulty, self.question)])
     
   
   def update(self):
     db.session.commit()
+    questions_written([(self.id, self.category_id, self.difficulty, self.question)], replace=True)
 
   def delete(self):
+    question_id, category, difficulty = self.id, self.category_id, self.difficulty
     db.session.delete(self)
     db.session.commit()
+    questions_removed([(question_id, category, difficulty)])
+
+  @classmethod
+  def insert_many(cls, rows):
+    '''
+    inserts a batch of row dicts in one transaction and returns their ids in
+    input order. Postgres gets a single multi-row INSERT ... RETURNING; other
+    dialects flush the batch through the unit of work before one commit.
+    '''
+    if not rows:
+      return []
+    if db.engine.dialect.name == 'postgresql':
+      statement = cls.__table__.insert().values(rows).returning(cls.__table__.c.id)
+      ids = [row[0] for row in db.session.execute(statement)]
+    else:
+      questions = [cls(row['question'], row['answer'], row['category_id'], row['difficulty']) for row in rows]
+      db.session.add_all(questions)
+      db.session.flush()
+      ids = [question.id for question in questions]
+    db.session.commit()
+    questions_written([(question_id, row['category_id'], row['difficulty'], row['question']) for question_id, row in zip(ids, rows)])
+    return ids
+
+  @classmethod
+  def delete_many(cls, question_ids):
+    '''
+    deletes the given ids with one DELETE in one transaction and returns
+    the ids that existed. Postgres reports them via DELETE ... RETURNING;
+    other dialects read them in the same transaction first.
+    '''
+    if not question_ids:
+      return []
+    table = cls.__table__
+    condition = table.c.id.in_(question_ids)
+    columns = [table.c.id, table.c.category_id, table.c.difficulty]
+    if db.engine.dialect.name == 'postgresql':
+      rows = db.session.execute(table.delete().where(condition).returning(*columns)).fetchall()
+    else:
+      rows = db.session.execute(table.select().with_only_columns(columns).where(condition)).fetchall()
+      db.session.execute(table.delete().where(condition))
+    db.session.commit()
+    questions_removed([tuple(row) for row in rows])
+    return [row[0] for row in rows]
 
   def format(self):
     return {
       'id': self.id,
       'question': self.question,
       'answer': self.answer,
-      'category': self.category,
+      'category': self.category_id,
       'difficulty': self.difficulty
     }
 
+  @classmethod
+  def projection(cls):
+    return [cls.id, cls.question, cls.answer, cls.category_id.label('category'), cls.difficulty]
+
+  @classmethod
+  def format_row(cls, row):
+    '''
+    same dict as format() for a tuple selected with projection(),
+    so listings can skip building ORM objects
+    '''
+    return dict(zip(cls.format_columns, row))
+
+'''
+reset_caches()
+    drops every in-process cache so the next read reloads from the database,
+    e.g. after binding a new database or rolling back a test transaction
+'''
+def reset_caches():
+  question_sampler.invalidate()
+  question_search.invalidate()
+  category_cache.invalidate()
+  fragment_cache.clear()
+  search_cache.clear()
+  question_counters.invalidate()
+
+'''
+questions_written(rows, replace=False) / questions_removed(rows)
+    called after a commit that wrote or deleted questions so the version
+    counter and the in-process pools and indexes stay consistent with the table
+'''
+def questions_written(rows, replace=False):
+  table_versions.bump(Question.__tablename__)
+  snapshot_changed()
+  if replace:
+    # the old category/difficulty are gone, so let the counters recount
+    question_counters.invalidate()
+  for question_id, category, difficulty, text in rows:
+    if replace:
+      # the category may have changed, so drop the id everywhere before re-adding it
+      question_sampler.remove(question_id)
+      fragment_cache.discard(question_id)
+    else:
+      question_counters.added(category, difficulty)
+    question_sampler.add(question_id, category, difficulty)
+    question_search.add(question_id, text)
+
+def questions_removed(rows):
+  table_versions.bump(Question.__tablename__)
+  snapshot_changed()
+  for question_id, category, difficulty in rows:
+    question_counters.removed(category, difficulty)
+    question_sampler.remove(question_id, category)
+    question_search.remove(question_id)
+    fragment_cache.discard(question_id)
+
+'''
+export_snapshot(path) / snapshot_changed()
+    export_snapshot writes the question bank to a snapshot file;
+    snapshot_changed only marks the snapshot stale after a committed write,
+    the export itself runs off the request path (see SnapshotStore)
+'''
+def export_snapshot(path):
+  questions = db.session.query(*Question.projection()).order_by(Question.id)
+  categories = db.session.query(*Category.projection()).order_by(Category.id)
+  write_snapshot(path, questions, categories, lambda row: dumps(Question.format_row(row)))
+
+def snapshot_changed():
+  if not has_app_context():
+    return
+  store = snapshot_for(current_app)
+  if store is not None:
+    store.mark_changed()
+
+'''
+question_sampler
+    process-wide id pools used by the quiz endpoint to pick random questions
+'''
+question_sampler = QuestionSampler(lambda: db.session.query(Question.id, Question.category_id, Question.difficulty).all())
+
+'''
+fragment_cache
+    encoded JSON of individual questions, keyed by id, shared by the listing,
+    category and quiz endpoints
+'''
+fragment_cache = FragmentCache()
+
+'''
+question_counters
+    per-category / per-difficulty question counts read by every handler
+'''
+question_counters = QuestionCounters(lambda: db.session.query(Question.category_id, Question.difficulty, func.count(Question.id))
+  .group_by(Question.category_id, Question.difficulty).all())
+
+'''
+question_search
+    search backend for /questions/search (database indexes on Postgres,
+    an in-process inverted index elsewhere)
+'''
+question_search = QuestionSearch(lambda: db.session.query(Question.id, Question.question).all())
+
+'''
+search_cache
+    result pages of /questions/search by normalized term, dropped whenever
+    the questions table version moves
+'''
+search_cache = SearchResultCache(table_versions)
+
 '''
 Category
 
@@ -73,22 +290,44 @@ class Category(db.Model):
   id = Column(Integer, primary_key=True)
   type = Column(String, nullable=False)
 
+  format_columns = ('id', 'type')
+
   def __init__(self, type):
     self.type = type
     
   def insert(self):
     db.session.add(self)
     db.session.commit()
+    table_versions.bump(self.__tablename__)
+    snapshot_changed()
     
   def update(self):
     db.session.commit()
+    table_versions.bump(self.__tablename__)
+    snapshot_changed()
 
   def delete(self):
     db.session.delete(self)
     db.session.commit()
+    table_versions.bump(self.__tablename__)
+    snapshot_changed()
 
   def format(self):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+  @classmethod
+  def projection(cls):
+    return [getattr(cls, column) for column in cls.format_columns]
+
+  @classmethod
+  def format_row(cls, row):
+    return dict(zip(cls.format_columns, row))
+
+'''
+category_cache
+    shared id -> type map of the categories table, invalidated by Category writes
+'''
+category_cache = CategoryCache(lambda: db.session.query(Category.id, Category.type).order_by(Category.id).all(), table_versions)
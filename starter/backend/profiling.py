@@ -0,0 +1,131 @@
+import json
+import logging
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_log = logging.getLogger('trivia.slow')
+
+MAX_RECORDED_STATEMENTS = 50
+
+'''
+RequestProfile
+    timings gathered while one request is served: SQL statements (count and
+    time, from engine events), ORM hydration (time spent turning rows into
+    objects, net of SQL) and JSON serialization
+'''
+class RequestProfile:
+  __slots__ = ('started', 'sql_count', 'sql_time', 'orm_time', 'serialize_time', 'statements')
+
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.sql_count = 0
+    self.sql_time = 0.0
+    self.orm_time = 0.0
+    self.serialize_time = 0.0
+    self.statements = []
+
+  def server_timing(self, total):
+    return ', '.join([
+      'sql;dur={:.2f};desc="{} queries"'.format(self.sql_time * 1000, self.sql_count),
+      'orm;dur={:.2f}'.format(self.orm_time * 1000),
+      'serialize;dur={:.2f}'.format(self.serialize_time * 1000),
+      'total;dur={:.2f}'.format(total * 1000)
+    ])
+
+def current_profile():
+  if not has_request_context():
+    return None
+  return g.get('profile')
+
+def record_serialization(seconds):
+  profile = current_profile()
+  if profile is not None:
+    profile.serialize_time += seconds
+
+# after_cursor_execute never fires for a failed statement, so the start time is
+# kept on its execution context rather than piling up on the pooled connection
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+  if context is not None:
+    context.query_started = time.perf_counter()
+  else:
+    connection.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+  if context is not None:
+    started = getattr(context, 'query_started', None)
+  else:
+    started = connection.info.pop('query_started', None)
+  profile = current_profile()
+  if profile is None or started is None:
+    return
+  elapsed = time.perf_counter() - started
+  profile.sql_count += 1
+  profile.sql_time += elapsed
+  if len(profile.statements) < MAX_RECORDED_STATEMENTS:
+    profile.statements.append((elapsed, statement))
+
+'''
+ProfilingQuery
+    query class that charges the time spent materializing ORM results,
+    minus the SQL time inside that window, to the request's orm timing.
+    yield_per() queries are streamed and left untouched.
+'''
+class ProfilingQuery(BaseQuery):
+
+  def __iter__(self):
+    profile = current_profile()
+    if profile is None or self._yield_per:
+      return BaseQuery.__iter__(self)
+    started, sql_before = time.perf_counter(), profile.sql_time
+    rows = list(BaseQuery.__iter__(self))
+    profile.orm_time += (time.perf_counter() - started) - (profile.sql_time - sql_before)
+    return iter(rows)
+
+'''
+init_profiling(app)
+    adds a Server-Timing header to every response and logs requests slower
+    than SLOW_REQUEST_MS to the 'trivia.slow' logger (and SLOW_LOG_PATH when
+    set) as one JSON object including the slowest SQL statements.
+    PROFILE_REQUESTS = False turns it off.
+'''
+def init_profiling(app):
+  if not app.config.get('PROFILE_REQUESTS', True):
+    return
+  threshold = app.config.get('SLOW_REQUEST_MS', 500) / 1000.0
+  log_path = app.config.get('SLOW_LOG_PATH')
+  if log_path and not any(getattr(handler, 'baseFilename', None) == log_path for handler in slow_log.handlers):
+    slow_log.addHandler(logging.FileHandler(log_path))
+    slow_log.setLevel(logging.INFO)
+
+  @app.before_request
+  def start_profile():
+    g.profile = RequestProfile()
+
+  @app.after_request
+  def finish_profile(response):
+    profile = g.get('profile')
+    if profile is None:
+      return response
+    total = time.perf_counter() - profile.started
+    response.headers['Server-Timing'] = profile.server_timing(total)
+    if total >= threshold:
+      slowest = sorted(profile.statements, reverse=True)[:5]
+      slow_log.warning(json.dumps({
+        'method': request.method,
+        'path': request.full_path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(total * 1000, 3),
+        'sql_count': profile.sql_count,
+        'sql_ms': round(profile.sql_time * 1000, 3),
+        'orm_ms': round(profile.orm_time * 1000, 3),
+        'serialize_ms': round(profile.serialize_time * 1000, 3),
+        'statements': [{'duration_ms': round(elapsed * 1000, 3), 'sql': statement} for elapsed, statement in slowest]
+      }))
+    return response
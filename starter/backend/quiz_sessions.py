@@ -0,0 +1,147 @@
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+'''
+ShuffledDeck
+    lazy Fisher-Yates shuffle over a shared, read-only sequence of ids. The
+    sequence is never copied: pop() picks a random index among the ones not
+    dealt yet and records the swap in a dict, so a deck costs memory in
+    proportion to the questions dealt rather than to the pool.
+'''
+class ShuffledDeck:
+  __slots__ = ('pool', 'remaining', '_moved')
+
+  def __init__(self, pool):
+    self.pool = pool
+    self.remaining = len(pool)
+    self._moved = {}
+
+  def __len__(self):
+    return self.remaining
+
+  def _at(self, index):
+    moved = self._moved.get(index)
+    return self.pool[index] if moved is None else moved
+
+  def pop(self):
+    last = self.remaining - 1
+    pick = random.randint(0, last)
+    question_id = self._at(pick)
+    if pick != last:
+      self._moved[pick] = self._at(last)
+    self._moved.pop(last, None)
+    self.remaining = last
+    return question_id
+
+'''
+QuizSession
+    a shuffled deck of question ids for one quiz run; next() is an O(1) draw
+    from a ShuffledDeck over the pool it was created with. `lock` serializes
+    concurrent calls for the same token on a threaded server.
+'''
+class QuizSession:
+  __slots__ = ('token', 'category', 'deck', 'served', 'expires_at', 'lock')
+
+  def __init__(self, token, category, question_ids, ttl):
+    self.token = token
+    self.category = category
+    self.deck = ShuffledDeck(question_ids)
+    self.served = 0
+    self.expires_at = time.time() + ttl
+    self.lock = threading.Lock()
+
+  def next(self):
+    with self.lock:
+      if not self.deck:
+        return None
+      self.served += 1
+      return self.deck.pop()
+
+  def format(self):
+    return {
+      'token': self.token,
+      'quiz_category': self.category,
+      'remaining': len(self.deck),
+      'served': self.served
+    }
+
+'''
+WeightedQuizSession
+    a quiz run that draws every question by difficulty instead of dealing a
+    shuffled deck; `seen` holds the ids served so far and `plan` the
+    DifficultyPlan, which adaptive sessions move after every answer
+'''
+class WeightedQuizSession(QuizSession):
+  __slots__ = ('plan', 'seen', 'total')
+
+  def __init__(self, token, category, total, plan, ttl):
+    QuizSession.__init__(self, token, category, (), ttl)
+    self.plan = plan
+    self.seen = []
+    self.total = total
+
+  def served_question(self, question_id):
+    with self.lock:
+      self.served += 1
+      self.seen.append(question_id)
+
+  def format(self):
+    return dict(QuizSession.format(self), remaining=max(self.total - self.served, 0), **self.plan.format())
+
+'''
+QuizSessionStore
+    bounded in-process store of quiz sessions keyed by token. Entries expire
+    `ttl` seconds after their last use and the least recently used session is
+    evicted once `max_sessions` is reached.
+'''
+class QuizSessionStore:
+
+  def __init__(self, max_sessions=10000, ttl=1800):
+    self.max_sessions = max_sessions
+    self.ttl = ttl
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._sessions)
+
+  def _evict_expired(self, now):
+    # sessions are kept in last-use order, so expired ones sit at the front
+    while self._sessions:
+      token, session = next(iter(self._sessions.items()))
+      if session.expires_at > now:
+        break
+      del self._sessions[token]
+
+  def create(self, category, question_ids):
+    return self._store(QuizSession(secrets.token_urlsafe(16), category, question_ids, self.ttl))
+
+  def create_weighted(self, category, total, plan):
+    return self._store(WeightedQuizSession(secrets.token_urlsafe(16), category, total, plan, self.ttl))
+
+  def _store(self, session):
+    token = session.token
+    with self._lock:
+      self._evict_expired(time.time())
+      while len(self._sessions) >= self.max_sessions:
+        self._sessions.popitem(last=False)
+      self._sessions[token] = session
+    return session
+
+  def get(self, token):
+    with self._lock:
+      now = time.time()
+      self._evict_expired(now)
+      session = self._sessions.get(token)
+      if session is None:
+        return None
+      session.expires_at = now + self.ttl
+      self._sessions.move_to_end(token)
+      return session
+
+  def discard(self, token):
+    with self._lock:
+      return self._sessions.pop(token, None) is not None
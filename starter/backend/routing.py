@@ -0,0 +1,121 @@
+import random
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+from metrics import TimedQueuePool
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+READ_YOUR_WRITES_COOKIE = 'trivia_primary_until'
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_pre_ping', 'pool_recycle', 'pool_timeout')
+
+def engine_options(url, options):
+  '''
+  keeps only the pool settings create_engine accepts for this url;
+  SQLite does not use a sized queue pool so pool_size/max_overflow are dropped,
+  other databases get a TimedQueuePool so checkout waits are measured
+  '''
+  options = {key: value for key, value in (options or {}).items() if key in POOL_OPTIONS}
+  if make_url(url).drivername.startswith('sqlite'):
+    options.pop('pool_size', None)
+    options.pop('max_overflow', None)
+    options.pop('pool_timeout', None)
+  else:
+    options['poolclass'] = TimedQueuePool
+  return options
+
+'''
+read_only(view)
+    marks a non-GET view (e.g. the quiz and search POSTs) as safe to serve
+    from a replica
+'''
+def read_only(view):
+  view.read_only = True
+  return view
+
+'''
+ReplicaSet
+    the replica engines of one app, created lazily, plus the read-your-writes
+    window in seconds
+'''
+class ReplicaSet:
+
+  def __init__(self, urls, options=None, read_your_writes=0):
+    self.urls = list(urls)
+    self.options = options
+    self.read_your_writes = read_your_writes
+    self._engines = None
+
+  @property
+  def engines(self):
+    # created on first read so app start-up (and a pre-fork master) stays offline
+    if self._engines is None:
+      self._engines = [create_engine(url, **engine_options(url, self.options)) for url in self.urls]
+    return self._engines
+
+  def choose(self):
+    return random.choice(self.engines)
+
+  def dispose(self):
+    for engine in self._engines or ():
+      engine.dispose()
+
+def replicas_for(app):
+  return app.extensions.get('replicas')
+
+def init_replicas(app, urls, options=None, read_your_writes=0):
+  first_setup = 'replicas' not in app.extensions
+  previous = replicas_for(app)
+  if previous is not None:
+    previous.dispose()
+  app.extensions['replicas'] = ReplicaSet(urls, options, read_your_writes) if urls else None
+  if not first_setup:
+    return
+
+  @app.after_request
+  def remember_write(response):
+    replicas = replicas_for(app)
+    if replicas is not None and replicas.read_your_writes and g.get('db_wrote'):
+      until = time.time() + replicas.read_your_writes
+      response.set_cookie(READ_YOUR_WRITES_COOKIE, '{:.3f}'.format(until), max_age=int(replicas.read_your_writes) + 1)
+    return response
+
+def request_reads_from_replica():
+  if not has_request_context():
+    return False
+  if request.method not in READ_METHODS:
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, 'read_only', False):
+      return False
+  try:
+    primary_until = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+  except ValueError:
+    primary_until = 0
+  return primary_until < time.time()
+
+'''
+RoutingSession
+    session that sends flushes and every statement of a session that has
+    written to the primary engine, and reads made while serving read-only
+    requests to a randomly chosen replica. Without replicas it behaves like
+    the stock SignallingSession.
+'''
+class RoutingSession(SignallingSession):
+
+  def __init__(self, *args, **kwargs):
+    SignallingSession.__init__(self, *args, **kwargs)
+    self.wrote = False
+
+  def get_bind(self, mapper=None, clause=None):
+    if self._flushing or isinstance(clause, UpdateBase):
+      self.wrote = True
+      if has_request_context():
+        g.db_wrote = True
+    replicas = replicas_for(self.app)
+    if replicas is not None and not self.wrote and request_reads_from_replica():
+      return replicas.choose()
+    return SignallingSession.get_bind(self, mapper, clause)
@@ -0,0 +1,206 @@
+import random
+import threading
+import time
+
+from difficulty import MAX_TABLES, weighted_draw
+
+ALL_CATEGORIES = None
+
+class _Pool:
+  __slots__ = ('ids', 'positions', 'shared')
+
+  def __init__(self):
+    self.ids = []
+    self.positions = {}
+    # ids was handed out by QuestionSampler.ids(), so copy it before writing
+    self.shared = False
+
+  def _own(self):
+    if self.shared:
+      self.ids = list(self.ids)
+      self.shared = False
+
+  def add(self, question_id):
+    if question_id in self.positions:
+      return
+    self._own()
+    self.positions[question_id] = len(self.ids)
+    self.ids.append(question_id)
+
+  def remove(self, question_id):
+    position = self.positions.pop(question_id, None)
+    if position is None:
+      return
+    self._own()
+    # swap the last id into the hole so removal stays O(1)
+    last = self.ids.pop()
+    if position < len(self.ids):
+      self.ids[position] = last
+      self.positions[last] = position
+
+
+'''
+QuestionSampler
+    keeps per-category pools of question ids in memory so the quiz can draw
+    a random unused question without ORDER BY random() over the whole table.
+    Pools are loaded lazily from `loader` (an iterable of (id, category,
+    difficulty) rows), kept in step with Question.insert/delete and rebuilt
+    after `max_age` seconds to pick up writes made by other worker processes.
+    Every pool is also split by difficulty, and the alias tables that weighted
+    draws sample levels from are cached per pool and curve; a write only drops
+    the tables of the pools it touched.
+'''
+class QuestionSampler:
+
+  def __init__(self, loader, max_age=300):
+    self.loader = loader
+    self.max_age = max_age
+    self._lock = threading.Lock()
+    self._pools = None
+    self._levels = None
+    self._difficulty = None
+    self._tables = {}
+    self._loaded_at = None
+
+  def _key(self, category):
+    if category in (None, 0, '0', ''):
+      return ALL_CATEGORIES
+    return str(category)
+
+  def _ensure_loaded(self):
+    if self._pools is not None and time.time() - self._loaded_at < self.max_age:
+      return
+    self._pools = {ALL_CATEGORIES: _Pool()}
+    self._levels = {ALL_CATEGORIES: {}}
+    self._difficulty = {}
+    self._tables = {}
+    for question_id, category, difficulty in self.loader():
+      self._add(question_id, category, difficulty)
+    self._loaded_at = time.time()
+
+  def _add(self, question_id, category, difficulty):
+    self._difficulty[question_id] = difficulty
+    for key in (ALL_CATEGORIES, str(category)):
+      self._pools.setdefault(key, _Pool()).add(question_id)
+      self._levels.setdefault(key, {}).setdefault(difficulty, _Pool()).add(question_id)
+      self._tables.pop(key, None)
+
+  def _remove(self, question_id, key):
+    pool = self._pools.get(key)
+    if pool is None or question_id not in pool.positions:
+      return
+    pool.remove(question_id)
+    levels = self._levels[key]
+    difficulty = self._difficulty.get(question_id)
+    level = levels.get(difficulty)
+    if level is not None:
+      level.remove(question_id)
+      if not level.ids:
+        del levels[difficulty]
+    self._tables.pop(key, None)
+
+  def invalidate(self):
+    with self._lock:
+      self._pools = None
+
+  def add(self, question_id, category, difficulty=None):
+    with self._lock:
+      if self._pools is None:
+        return
+      self._add(question_id, category, difficulty)
+
+  def remove(self, question_id, category=None):
+    with self._lock:
+      if self._pools is None:
+        return
+      keys = list(self._pools) if category is None else (ALL_CATEGORIES, str(category))
+      for key in keys:
+        self._remove(question_id, key)
+      self._difficulty.pop(question_id, None)
+
+  def _table(self, key, curve):
+    tables = self._tables.setdefault(key, {})
+    table = tables.get(curve.key)
+    if table is None:
+      if len(tables) >= MAX_TABLES:
+        tables.clear()
+      table = tables[curve.key] = curve.table({difficulty: level.ids for difficulty, level in self._levels[key].items()})
+    return table
+
+  def count(self, category=None, curve=None):
+    '''
+    questions in `category`; with a DifficultyCurve, only those a weighted
+    draw can return
+    '''
+    with self._lock:
+      self._ensure_loaded()
+      key = self._key(category)
+      if curve is not None:
+        return curve.covered({difficulty: level.ids for difficulty, level in self._levels.get(key, {}).items()})
+      pool = self._pools.get(key)
+      return len(pool.ids) if pool is not None else 0
+
+  def ids(self, category):
+    '''
+    the ids of `category`, shared rather than copied: the caller must not
+    modify the list, and the pool copies it on its next write instead
+    '''
+    with self._lock:
+      self._ensure_loaded()
+      pool = self._pools.get(self._key(category))
+      if pool is None:
+        return []
+      pool.shared = True
+      return pool.ids
+
+  def draw(self, category, exclude=(), curve=None):
+    '''
+    returns (question_id, remaining) where remaining is the number of unused
+    candidates before this draw; question_id is None when none are left.
+    With a DifficultyCurve, questions are drawn in proportion to the weight
+    of their difficulty.
+    '''
+    question_ids, remaining = self.draw_many(category, exclude, 1, curve)
+    return (question_ids[0] if question_ids else None), remaining
+
+  def draw_many(self, category, exclude=(), count=1, curve=None):
+    '''
+    up to `count` distinct unused question ids drawn like draw(), and the
+    number of unused candidates before the draw
+    '''
+    with self._lock:
+      self._ensure_loaded()
+      key = self._key(category)
+      pool = self._pools.get(key)
+      if pool is None:
+        return [], 0
+
+      excluded = set(exclude)
+      remaining = len(pool.ids) - sum(1 for question_id in excluded if question_id in pool.positions)
+      if remaining <= 0:
+        return [], 0
+
+      drawn = []
+      if curve is not None:
+        levels = {difficulty: level.ids for difficulty, level in self._levels[key].items()}
+        table = self._table(key, curve)
+        while len(drawn) < min(count, remaining):
+          question_id = weighted_draw(levels, table, curve, excluded)
+          if question_id is None:
+            break
+          drawn.append(question_id)
+          excluded.add(question_id)
+        return drawn, remaining
+
+      while len(drawn) < min(count, remaining):
+        # rejection sampling is O(1) expected while at least half the pool is unused;
+        # past that point the filtered scan is cheaper than repeated misses
+        if (remaining - len(drawn)) * 2 < len(pool.ids):
+          candidates = [question_id for question_id in pool.ids if question_id not in excluded]
+          drawn.extend(random.sample(candidates, min(count - len(drawn), len(candidates))))
+          break
+        question_id = pool.ids[random.randrange(len(pool.ids))]
+        if question_id not in excluded:
+          drawn.append(question_id)
+          excluded.add(question_id)
+      return drawn, remaining
@@ -0,0 +1,158 @@
+import math
+import re
+import threading
+import time
+
+from sqlalchemy import func, text
+
+SUBSTRING = 'substring'
+FULLTEXT = 'fulltext'
+SEARCH_MODES = (SUBSTRING, FULLTEXT)
+
+POSTGRES_INDEXES = (
+  "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+  "CREATE INDEX IF NOT EXISTS ix_questions_question_trgm ON questions USING gin (question gin_trgm_ops)",
+  "CREATE INDEX IF NOT EXISTS ix_questions_question_tsv ON questions USING gin (to_tsvector('english', question))",
+)
+
+def tokenize(value):
+  return re.findall(r'\w+', value.lower())
+
+def trigrams(value):
+  return {value[i:i + 3] for i in range(len(value) - 2)}
+
+def escape_like(value):
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+'''
+InvertedIndex
+    in-process index over question text for databases without GIN indexes.
+    Trigram postings answer substring queries (candidates are verified against
+    the lowered text), word postings answer ranked full-text queries.
+'''
+class InvertedIndex:
+
+  def __init__(self):
+    self.texts = {}
+    self.grams = {}
+    self.words = {}
+
+  def add(self, question_id, value):
+    self.remove(question_id)
+    lowered = value.lower()
+    self.texts[question_id] = lowered
+    for gram in trigrams(lowered):
+      self.grams.setdefault(gram, set()).add(question_id)
+    for word in tokenize(lowered):
+      postings = self.words.setdefault(word, {})
+      postings[question_id] = postings.get(question_id, 0) + 1
+
+  def remove(self, question_id):
+    lowered = self.texts.pop(question_id, None)
+    if lowered is None:
+      return
+    for gram in trigrams(lowered):
+      postings = self.grams.get(gram)
+      postings.discard(question_id)
+      if not postings:
+        del self.grams[gram]
+    for word in set(tokenize(lowered)):
+      postings = self.words.get(word)
+      postings.pop(question_id, None)
+      if not postings:
+        del self.words[word]
+
+  def substring(self, term):
+    lowered = term.lower()
+    grams = trigrams(lowered)
+    if not grams:
+      # too short to use the trigram postings
+      candidates = self.texts.keys()
+    else:
+      postings = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+      candidates = set.intersection(*postings)
+    return sorted(question_id for question_id in candidates if lowered in self.texts[question_id])
+
+  def fulltext(self, term):
+    words = set(tokenize(term))
+    if not words:
+      return []
+    postings = [self.words.get(word, {}) for word in words]
+    if not all(postings):
+      return []
+    total = len(self.texts)
+    scores = {}
+    for question_id in set.intersection(*(set(p) for p in postings)):
+      scores[question_id] = sum(p[question_id] * math.log(1 + total / len(p)) for p in postings)
+    return sorted(scores, key=lambda question_id: (-scores[question_id], question_id))
+
+'''
+QuestionSearch
+    search backend for /questions/search. On Postgres the work stays in the
+    database (trigram GIN index for substring mode, tsvector GIN index and
+    ts_rank for full-text mode) and selection() returns a Query to paginate.
+    Other databases use an InvertedIndex loaded lazily from `loader`, kept in
+    step with Question.insert/update/delete, and ids() returns the matches.
+'''
+class QuestionSearch:
+
+  def __init__(self, loader, max_age=300):
+    self.loader = loader
+    self.max_age = max_age
+    self._lock = threading.Lock()
+    self._index = None
+    self._loaded_at = None
+
+  def in_database(self, engine):
+    return engine.dialect.name == 'postgresql'
+
+  def ensure_indexes(self, engine):
+    if not self.in_database(engine):
+      return False
+    try:
+      with engine.begin() as connection:
+        for statement in POSTGRES_INDEXES:
+          connection.execute(text(statement))
+      return True
+    except Exception:
+      # pg_trgm may need superuser rights; searches still work, just unindexed
+      return False
+
+  def selection(self, model, term, mode=SUBSTRING):
+    if mode == FULLTEXT:
+      document = func.to_tsvector('english', model.question)
+      query = func.plainto_tsquery('english', term)
+      return model.query.filter(document.op('@@')(query)) \
+        .order_by(func.ts_rank(document, query).desc(), model.id)
+    return model.query.filter(model.question.ilike('%{}%'.format(escape_like(term)), escape='\\')) \
+      .order_by(model.id)
+
+  def _ensure_loaded(self):
+    if self._index is not None and time.time() - self._loaded_at < self.max_age:
+      return
+    index = InvertedIndex()
+    for question_id, value in self.loader():
+      index.add(question_id, value)
+    self._index = index
+    self._loaded_at = time.time()
+
+  def ids(self, term, mode=SUBSTRING):
+    with self._lock:
+      self._ensure_loaded()
+      if mode == FULLTEXT:
+        return self._index.fulltext(term)
+      return self._index.substring(term)
+
+  def invalidate(self):
+    with self._lock:
+      self._index = None
+
+  def add(self, question_id, value):
+    with self._lock:
+      if self._index is not None:
+        self._index.add(question_id, value)
+
+  def remove(self, question_id):
+    with self._lock:
+      if self._index is not None:
+        self._index.remove(question_id)
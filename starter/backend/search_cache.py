@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+def normalize_term(term):
+  '''
+  lower-cased search term with runs of whitespace collapsed to one space,
+  so "Title", " title " and "TITLE" share a cache entry. This is the fold
+  the search backends apply (ilike, InvertedIndex), unlike casefold(),
+  which would turn "ß" into "ss" and miss questions containing "ß".
+  '''
+  return ' '.join(term.lower().split())
+
+'''
+SearchResultCache
+    LRU cache of search result pages keyed by (normalized term, mode, page),
+    holding at most `max_entries` (ids on the page, total, next_cursor)
+    tuples. The whole cache is dropped when the 'questions' version in
+    `versions` moves, so any insert, update or delete invalidates it, and
+    entries older than `max_age` seconds are misses so writes made by other
+    worker processes show up. put() takes the version read before the search
+    ran and ignores results computed against an older table.
+'''
+class SearchResultCache:
+
+  def __init__(self, versions, max_entries=1024, max_age=60):
+    self.versions = versions
+    self.max_entries = max_entries
+    self.max_age = max_age
+    self._entries = OrderedDict()
+    self._version = None
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  @property
+  def version(self):
+    return self.versions.get('questions')
+
+  def _check_version(self):
+    version = self.version
+    if version != self._version:
+      if self._entries:
+        self.invalidations += 1
+      self._entries.clear()
+      self._version = version
+    return version
+
+  def get(self, key):
+    with self._lock:
+      self._check_version()
+      entry = self._entries.get(key)
+      if entry is None or time.time() - entry[1] >= self.max_age:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, result, version):
+    with self._lock:
+      if self._check_version() != version:
+        return
+      self._entries.pop(key, None)
+      self._entries[key] = (result, time.time())
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self._entries),
+        'max_entries': self.max_entries,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations
+      }
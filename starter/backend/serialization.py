@@ -0,0 +1,73 @@
+import json
+import time
+
+from flask import current_app
+
+from profiling import record_serialization
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+def _stdlib_dumps(payload):
+  return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+def _orjson_dumps(payload):
+  # categories are keyed by integer id
+  return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+
+JSON_BACKENDS = {'stdlib': _stdlib_dumps}
+if orjson is not None:
+  JSON_BACKENDS['orjson'] = _orjson_dumps
+
+'''
+init_json(app)
+    picks the JSON encoder for the app from JSON_BACKEND: 'auto' (orjson when
+    installed, the standard library otherwise), 'orjson' or 'stdlib'
+'''
+def init_json(app):
+  backend = app.config.get('JSON_BACKEND', 'auto')
+  if backend == 'auto':
+    backend = 'orjson' if 'orjson' in JSON_BACKENDS else 'stdlib'
+  if backend not in JSON_BACKENDS:
+    raise ValueError('unknown JSON_BACKEND {!r}'.format(backend))
+  app.extensions['json_dumps'] = JSON_BACKENDS[backend]
+
+def dumps(payload):
+  dumper = current_app.extensions.get('json_dumps', _stdlib_dumps)
+  started = time.perf_counter()
+  encoded = dumper(payload)
+  record_serialization(time.perf_counter() - started)
+  return encoded
+
+'''
+RawJSON / RawJSONArray
+    already-encoded JSON (e.g. cached question fragments) that jsonify splices
+    into the response body as-is instead of encoding again
+'''
+class RawJSON(bytes):
+  pass
+
+class RawJSONArray(list):
+  def encode(self):
+    return b'[' + b','.join(self) + b']'
+
+def _encode_value(value):
+  if isinstance(value, RawJSON):
+    return bytes(value)
+  if isinstance(value, RawJSONArray):
+    return value.encode()
+  return dumps(value)
+
+'''
+jsonify(payload)
+    drop-in for flask.jsonify that encodes with the app's configured backend.
+    Top-level RawJSON/RawJSONArray values are spliced in without re-encoding.
+'''
+def jsonify(payload):
+  if any(isinstance(value, (RawJSON, RawJSONArray)) for value in payload.values()):
+    body = b'{' + b','.join(dumps(str(key)) + b':' + _encode_value(value) for key, value in payload.items()) + b'}'
+  else:
+    body = dumps(payload)
+  return current_app.response_class(body, mimetype='application/json')
@@ -0,0 +1,460 @@
+import bisect
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from array import array
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from flask import current_app, has_app_context
+
+from difficulty import MAX_TABLES, weighted_draw
+
+snapshot_log = logging.getLogger('trivia.snapshot')
+
+'''
+Snapshot file layout (little-endian, every section 4-byte aligned)
+
+    header      magic, format version, build time, counts
+    ids         u32 question id per record, ascending
+    records     (category index u32, difficulty i32, fragment offset u32,
+                fragment length u32) per question, same order as ids
+    categories  (name offset, name length, first position, position count)
+                per distinct questions.category value (interned)
+    positions   u32 record numbers grouped by category, ascending within each
+    levels      (category index, difficulty, first level position, count) per
+                distinct difficulty of each category, and of all questions
+                (category index ALL_INDEX)
+    level positions
+                u32 record numbers grouped by category and difficulty
+    types       (id, type offset, type length) per row of the categories table
+    heap        utf-8 category names and types, and the encoded JSON of each
+                question exactly as the API returns it
+'''
+MAGIC = b'TRIVSNAP'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIdIIII')
+RECORD = struct.Struct('<IiII')
+CATEGORY = struct.Struct('<IIII')
+LEVEL = struct.Struct('<IiII')
+TYPE = struct.Struct('<III')
+ID = struct.Struct('<I')
+
+ALL_CATEGORIES = None
+ALL_INDEX = 0xFFFFFFFF
+
+def write_snapshot(path, questions, categories, encode):
+  '''
+  writes a snapshot of `questions` ((id, question, answer, category,
+  difficulty) rows in id order) and `categories` ((id, type) rows) to `path`;
+  encode(row) gives the JSON fragment stored for a question row
+  '''
+  heap = bytearray()
+
+  def store(data):
+    offset = len(heap)
+    heap.extend(data)
+    return offset, len(data)
+
+  ids, records, grouped, names = [], [], {}, []
+  interned = {}
+  leveled = {}
+  for position, row in enumerate(questions):
+    question_id, category, difficulty = row[0], str(row[3]), row[4] if row[4] is not None else 0
+    if category not in interned:
+      interned[category] = len(names)
+      names.append(category)
+      grouped[category] = []
+    grouped[category].append(position)
+    for index in (interned[category], ALL_INDEX):
+      leveled.setdefault((index, difficulty), []).append(position)
+    ids.append(question_id)
+    records.append((interned[category], difficulty) + store(encode(row)))
+
+  category_entries, positions = [], []
+  for name in names:
+    category_entries.append(store(name.encode('utf-8')) + (len(positions), len(grouped[name])))
+    positions.extend(grouped[name])
+  level_entries, level_positions = [], []
+  for (index, difficulty), members in sorted(leveled.items()):
+    level_entries.append((index, difficulty, len(level_positions), len(members)))
+    level_positions.extend(members)
+  type_entries = [(type_id,) + store(type_name.encode('utf-8')) for type_id, type_name in categories]
+
+  sections = [
+    b''.join(ID.pack(question_id) for question_id in ids),
+    b''.join(RECORD.pack(*record) for record in records),
+    b''.join(CATEGORY.pack(*entry) for entry in category_entries),
+    b''.join(ID.pack(position) for position in positions),
+    b''.join(LEVEL.pack(*entry) for entry in level_entries),
+    b''.join(ID.pack(position) for position in level_positions),
+    b''.join(TYPE.pack(*entry) for entry in type_entries)
+  ]
+  header = HEADER.pack(MAGIC, FORMAT_VERSION, time.time(), len(ids), len(names), len(level_entries), len(type_entries))
+
+  temporary = '{}.{}.tmp'.format(path, os.getpid())
+  with open(temporary, 'wb') as handle:
+    handle.write(header)
+    for section in sections:
+      handle.write(section)
+    handle.write(heap)
+  # readers either see the old file or the complete new one
+  os.replace(temporary, path)
+
+'''
+QuestionSnapshot
+    read-only view of one snapshot file. The file is mmap'd, so every worker
+    shares the same pages; id arrays are memoryviews into the mapping and
+    question fragments are returned as memoryview slices of it.
+'''
+class QuestionSnapshot:
+
+  def __init__(self, path):
+    with open(path, 'rb') as handle:
+      self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.built_at, question_count, category_count, level_count, type_count = HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise ValueError('{} is not a version {} question snapshot'.format(path, FORMAT_VERSION))
+
+    view = memoryview(self._map)
+    offset = HEADER.size
+    self._ids = view[offset:offset + ID.size * question_count].cast('I')
+    offset += ID.size * question_count
+    self._records_offset = offset
+    offset += RECORD.size * question_count
+    categories_offset = offset
+    offset += CATEGORY.size * category_count
+    positions_count = question_count
+    self._positions = view[offset:offset + ID.size * positions_count].cast('I')
+    offset += ID.size * positions_count
+    levels_offset = offset
+    offset += LEVEL.size * level_count
+    # every record is in the levels of its category and of all questions
+    level_positions = view[offset:offset + ID.size * 2 * question_count].cast('I')
+    offset += ID.size * 2 * question_count
+    types_offset = offset
+    offset += TYPE.size * type_count
+    self._heap = view[offset:]
+
+    self._names = []
+    self._groups = {}
+    for index in range(category_count):
+      name_offset, name_length, first, count = CATEGORY.unpack_from(self._map, categories_offset + index * CATEGORY.size)
+      name = bytes(self._heap[name_offset:name_offset + name_length]).decode('utf-8')
+      self._names.append(name)
+      self._groups[name] = self._positions[first:first + count]
+    self._levels = {}
+    for index in range(level_count):
+      category_index, difficulty, first, count = LEVEL.unpack_from(self._map, levels_offset + index * LEVEL.size)
+      key = ALL_CATEGORIES if category_index == ALL_INDEX else self._names[category_index]
+      self._levels.setdefault(key, {})[difficulty] = level_positions[first:first + count]
+    self._tables = {}
+    self._tables_lock = threading.Lock()
+    self._id_arrays = {}
+    self._types = {}
+    for index in range(type_count):
+      type_id, type_offset, type_length = TYPE.unpack_from(self._map, types_offset + index * TYPE.size)
+      self._types[type_id] = bytes(self._heap[type_offset:type_offset + type_length]).decode('utf-8')
+
+  def _key(self, category):
+    if category in (ALL_CATEGORIES, 0, '0', ''):
+      return ALL_CATEGORIES
+    return str(category)
+
+  def _pool(self, category):
+    '''
+    record numbers of `category` in id order; every record when category
+    is 0/None (the quiz's "all categories")
+    '''
+    key = self._key(category)
+    if key is ALL_CATEGORIES:
+      return range(len(self._ids))
+    return self._groups.get(key, ())
+
+  def _table(self, key, curve):
+    with self._tables_lock:
+      tables = self._tables.setdefault(key, {})
+      table = tables.get(curve.key)
+      if table is None:
+        if len(tables) >= MAX_TABLES:
+          tables.clear()
+        table = tables[curve.key] = curve.table(self._levels.get(key, {}))
+      return table
+
+  def _record(self, position):
+    return RECORD.unpack_from(self._map, self._records_offset + position * RECORD.size)
+
+  def _position_of(self, question_id):
+    position = bisect.bisect_left(self._ids, question_id)
+    if position < len(self._ids) and self._ids[position] == question_id:
+      return position
+    return None
+
+  def types(self):
+    return dict(self._types)
+
+  def type_of(self, category):
+    try:
+      return self._types.get(int(category))
+    except (TypeError, ValueError):
+      return None
+
+  def count(self, category=ALL_CATEGORIES, curve=None):
+    if curve is not None:
+      return curve.covered(self._levels.get(self._key(category), {}))
+    return len(self._pool(category))
+
+  def ids(self, category=ALL_CATEGORIES):
+    '''
+    the ids of `category` as an array('I') copied out of the mapping once
+    per category and shared by every caller, who must not modify it. Quiz
+    decks keep it for the session's lifetime, so it must not be a view that
+    would keep a replaced generation of the file mapped.
+    '''
+    key = self._key(category)
+    if key is not ALL_CATEGORIES and key not in self._groups:
+      return array('I')
+    with self._tables_lock:
+      ids = self._id_arrays.get(key)
+      if ids is None:
+        if key is ALL_CATEGORIES:
+          ids = array('I', self._ids.tobytes())
+        else:
+          ids = array('I', (self._ids[position] for position in self._groups[key]))
+        self._id_arrays[key] = ids
+      return ids
+
+  def category_at(self, position):
+    return self._names[self._record(position)[0]]
+
+  def fragment_at(self, position):
+    category_index, difficulty, offset, length = self._record(position)
+    return self._heap[offset:offset + length]
+
+  def fragment(self, question_id):
+    position = self._position_of(question_id)
+    return self.fragment_at(position) if position is not None else None
+
+  def window(self, category=ALL_CATEGORIES, page=1, after_id=None, per_page=10):
+    '''
+    one page of record numbers: LIMIT/OFFSET style for `page`, or a keyset
+    seek past `after_id`. Returns (positions, total, next_cursor) like
+    paginate().
+    '''
+    pool = self._pool(category)
+    total = len(pool)
+    if after_id is not None:
+      # ids ascend with record numbers and pools are ascending record numbers,
+      # so the seek is two binary searches
+      start = bisect.bisect_left(pool, bisect.bisect_right(self._ids, after_id))
+    else:
+      if page < 1:
+        return [], total, None
+      start = (page - 1) * per_page
+    positions = list(pool[start:start + per_page + 1])
+    next_cursor = self._ids[positions[per_page - 1]] if len(positions) > per_page else None
+    return positions[:per_page], total, next_cursor
+
+  def draw(self, category, exclude=(), curve=None):
+    '''
+    random unused question of `category`, same contract as
+    QuestionSampler.draw but returning (question_id, fragment, remaining)
+    '''
+    drawn, remaining = self.draw_many(category, exclude, 1, curve)
+    if not drawn:
+      return None, None, remaining
+    return drawn[0][0], drawn[0][1], remaining
+
+  def draw_many(self, category, exclude=(), count=1, curve=None):
+    '''
+    up to `count` distinct unused questions as QuestionSampler.draw_many,
+    returned as ([(question_id, fragment), ...], remaining)
+    '''
+    pool = self._pool(category)
+    excluded = set(exclude)
+    in_pool = 0
+    for question_id in excluded:
+      position = self._position_of(question_id) if isinstance(question_id, int) else None
+      if position is not None and (isinstance(pool, range) or self.category_at(position) == str(category)):
+        in_pool += 1
+    remaining = len(pool) - in_pool
+    if remaining <= 0:
+      return [], 0
+
+    positions = []
+    if curve is not None:
+      key = self._key(category)
+      levels = self._levels.get(key, {})
+      table = self._table(key, curve)
+      while len(positions) < min(count, remaining):
+        position = weighted_draw(levels, table, curve, excluded, lambda position: self._ids[position])
+        if position is None:
+          break
+        positions.append(position)
+        excluded.add(self._ids[position])
+    else:
+      while len(positions) < min(count, remaining):
+        if (remaining - len(positions)) * 2 < len(pool):
+          candidates = [position for position in pool if self._ids[position] not in excluded]
+          positions.extend(random.sample(candidates, min(count - len(positions), len(candidates))))
+          break
+        position = pool[random.randrange(len(pool))]
+        if self._ids[position] not in excluded:
+          positions.append(position)
+          excluded.add(self._ids[position])
+    return [(self._ids[position], self.fragment_at(position)) for position in positions], remaining
+
+'''
+SnapshotStore
+    the snapshot file of one app. current() returns the newest generation,
+    re-checking the file at most every `check_interval` seconds and mapping
+    it again when another process has replaced it; it returns None while no
+    snapshot exists, and while this process has committed writes the file
+    does not include yet, so callers fall back to the database.
+    mark_changed() is all a write does: a background thread per process
+    waits `export_interval` seconds, so writes arriving close together share
+    one export, and then calls export_pending(). With no export_interval the
+    file is only written by `flask export-snapshot`. rebuild() runs
+    `export(path)` under an exclusive file lock so concurrent writers cannot
+    swap in an older export over a newer one.
+'''
+class SnapshotStore:
+
+  def __init__(self, path, export, check_interval=1.0, export_interval=5.0, app=None):
+    self.path = path
+    self.export = export
+    self.check_interval = check_interval
+    self.export_interval = export_interval
+    self.app = app
+    self._lock = threading.Lock()
+    self._snapshot = None
+    self._identity = None
+    self._checked_at = 0.0
+    self._changes = 0
+    self._exported = 0
+    self._writer_pid = None
+    self._wake = None
+
+  def _file_identity(self):
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+  @property
+  def stale(self):
+    return self._exported < self._changes
+
+  def current(self):
+    if self.stale:
+      return None
+    return self._mapped()
+
+  def _mapped(self):
+    now = time.time()
+    if now - self._checked_at < self.check_interval:
+      return self._snapshot
+    with self._lock:
+      self._checked_at = now
+      identity = self._file_identity()
+      if identity != self._identity:
+        try:
+          self._snapshot = QuestionSnapshot(self.path) if identity is not None else None
+        except (OSError, ValueError):
+          snapshot_log.exception('could not map question snapshot %s', self.path)
+          self._snapshot = None
+        # the previous mapping is released once no response still uses it
+        self._identity = identity
+      return self._snapshot
+
+  def mark_changed(self):
+    with self._lock:
+      self._changes += 1
+    self._start_writer()
+
+  def rebuild(self):
+    changes = self._changes
+    with open(self.path + '.lock', 'a') as lock:
+      if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        self.export(self.path)
+      finally:
+        if fcntl is not None:
+          fcntl.flock(lock, fcntl.LOCK_UN)
+    with self._lock:
+      # writes committed during the export may be missing from it
+      self._exported = max(self._exported, changes)
+    self._checked_at = 0.0
+    return self._mapped()
+
+  def export_pending(self):
+    '''
+    writes a new generation if this process committed writes since the
+    last one; on failure the file is removed so no worker serves the stale
+    generation. Returns whether a generation was written.
+    '''
+    if not self.stale:
+      return False
+    try:
+      self.rebuild()
+      return True
+    except Exception:
+      snapshot_log.exception('question snapshot export failed, falling back to the database')
+      self.discard()
+      return False
+
+  def _start_writer(self):
+    if not self.export_interval or self.app is None:
+      return
+    with self._lock:
+      # threads do not survive a fork, so each worker starts its own
+      if self._writer_pid != os.getpid():
+        self._writer_pid = os.getpid()
+        self._wake = threading.Event()
+        threading.Thread(target=self._write_loop, args=(self._wake,), name='snapshot-writer', daemon=True).start()
+    self._wake.set()
+
+  def _write_loop(self, wake):
+    while True:
+      wake.wait()
+      time.sleep(self.export_interval)
+      wake.clear()
+      with self.app.app_context():
+        if not self.export_pending() and self.stale:
+          # failed; try again after the next interval
+          wake.set()
+
+  def discard(self):
+    '''
+    removes the file so every process falls back to the database, used
+    when a rebuild fails and the old generation would be stale
+    '''
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+    self._checked_at = 0.0
+
+def snapshot_for(app):
+  return app.extensions.get('question_snapshot')
+
+def current_snapshot():
+  '''
+  the current snapshot of the app serving this request, or None
+  '''
+  if not has_app_context():
+    return None
+  store = snapshot_for(current_app)
+  return store.current() if store is not None else None
+
+def init_snapshot(app, path, export, check_interval=1.0, export_interval=5.0):
+  app.extensions['question_snapshot'] = SnapshotStore(path, export, check_interval, export_interval, app) if path else None
@@ -1,23 +1,120 @@
+import gzip
 import os
+import re
+import shutil
+import subprocess
+import sys
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import random
+import sqlite3
+import tempfile
+import threading
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import MetaData, Table, create_engine, event, inspect, orm
+from sqlalchemy.pool import QueuePool
 
+from difficulty import AliasTable
 from flaskr import create_app
-from models import setup_db, Question, Category
+from quiz_sessions import QuizSession
+from snapshot import snapshot_for
+from models import BASELINE_REVISION, db, init_schema, reset_caches, Question, Category, fragment_cache, question_counters, search_cache
+
+# any SQLAlchemy url works, e.g. the trivia_test Postgres database; the default
+# in-memory SQLite database is created and seeded from trivia.psql on import
+TEST_DATABASE_URL = os.environ.get('TRIVIA_TEST_DATABASE_URL', 'sqlite://')
+TEST_CONFIG = {'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URL}
+SEED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trivia.psql')
+
+shared_app = None
+
+
+def read_dump_rows(path, table):
+    """Rows of `table` in the COPY ... FROM stdin block of a pg_dump file"""
+    with open(path) as dump:
+        text = dump.read()
+    match = re.search(r'^COPY public\.{} \((.*?)\) FROM stdin;\n(.*?)^\\\.$'.format(table.name), text, re.M | re.S)
+    columns = [column.strip() for column in match.group(1).split(',')]
+    types = [table.c[column].type.python_type for column in columns]
+    return [{column: kind(value) for column, kind, value in zip(columns, types, line.split('\t'))}
+            for line in match.group(2).splitlines()]
+
+
+def seed_database(path=SEED_PATH):
+    """Loads trivia.psql into an empty database at the baseline revision"""
+    # reflect before inserting: on a shared in-memory connection reflection would end the transaction
+    metadata = MetaData()
+    tables = [Table(name, metadata, autoload=True, autoload_with=db.engine) for name in ('categories', 'questions')]
+    for table in tables:
+        db.session.execute(table.insert(), read_dump_rows(path, table))
+    if db.engine.dialect.name == 'postgresql':
+        for name in ('categories', 'questions'):
+            db.session.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), (SELECT max(id) FROM {0}))".format(name))
+    db.session.commit()
+
+
+def enable_sqlite_savepoints(engine):
+    """pysqlite manages transactions itself and lets RELEASE SAVEPOINT commit;
+    hand BEGIN back to SQLAlchemy so nested transactions roll back cleanly"""
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+    # reconnect so the listeners apply to the (still empty) in-memory database
+    engine.dispose()
+
+
+def setUpModule():
+    """Creates the app, engine and seed data once for the whole module"""
+    global shared_app
+    shared_app = create_app(TEST_CONFIG)
+    with shared_app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            enable_sqlite_savepoints(db.engine)
+        if not inspect(db.engine).get_table_names():
+            # load trivia.psql in its own layout and migrate it like a live database
+            upgrade(revision=BASELINE_REVISION)
+            seed_database()
+        init_schema()
+
+
+def rollback_session(connection):
+    """Scoped session bound to `connection` whose sessions always work inside
+    a SAVEPOINT: commits release and reopen it, rollbacks go back to it, and
+    nothing outlives the transaction the test rolls back"""
+    factory = db.create_session({'bind': connection, 'binds': {}})
+
+    @event.listens_for(factory, 'after_transaction_end')
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested and transaction._parent.is_active:
+            session.expire_all()
+            session.begin_nested()
+
+    def start_session():
+        session = factory()
+        session.begin_nested()
+        return session
+
+    return orm.scoped_session(start_session, scopefunc=db.session.registry.scopefunc)
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables and wrap the test in a transaction."""
+        self.app = shared_app
         self.client = self.app.test_client
-        self.database_name = "trivia"
-        self.database_path = "postgresql+psycopg2://{}:{}@{}/{}".format('postgres', '1','localhost:5432', self.database_name)
 
-        setup_db(self.app, self.database_path)
+        self.connection = db.get_engine(self.app).connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = rollback_session(self.connection)
+        reset_caches()
 
         self.new_question = {
             "question": "How much wood can a wood chuck chuck?",
@@ -28,18 +125,14 @@ class TriviaTestCase(unittest.TestCase):
         self.new_category = {
             "type" : "Animals"
         }
-        
-        
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
     
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        """Executed after reach test: undo everything the test wrote"""
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+        reset_caches()
 
     """
     DONE 
@@ -66,7 +159,97 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource or url not found')
-    
+
+    def test_get_questions_keyset_cursor(self):
+        res = self.client().get('/questions')
+        first_page = json.loads(res.data)
+        res = self.client().get('/questions?after_id={}'.format(first_page['next_cursor']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], first_page['total_questions'])
+        self.assertTrue(data['questions'][0]['id'] > first_page['questions'][-1]['id'])
+        self.assertEqual(data['questions'], json.loads(self.client().get('/questions?page=2').data)['questions'])
+
+    def test_304_get_questions_with_matching_etag(self):
+        res = self.client().get('/questions?page=2')
+        etag = res.headers['ETag']
+
+        res = self.client().get('/questions?page=2', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertTrue(res.headers['Cache-Control'])
+
+    def test_200_get_questions_etag_changes_after_insert(self):
+        etag = self.client().get('/questions').headers['ETag']
+        self.client().post('/questions', json=self.new_question)
+
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertNotEqual(self.client().get('/questions?page=2').headers['ETag'], res.headers['ETag'])
+
+    def test_200_get_questions_gzip_cached_per_etag(self):
+        plain = self.client().get('/questions?page=2')
+        res = self.client().get('/questions?page=2', headers={'Accept-Encoding': 'gzip'})
+        cache = shared_app.extensions['compressed_cache']
+        hits = cache.hits
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"')
+
+        again = self.client().get('/questions?page=2', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(again.data, res.data)
+        self.assertEqual(cache.hits, hits + 1)
+        res = self.client().get('/questions?page=2', headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_200_small_and_streamed_responses_compression(self):
+        res = self.client().get('/categories', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+        res = self.client().get('/questions/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        rows = [json.loads(line) for line in gzip.decompress(res.data).decode('utf-8').splitlines()]
+        self.assertEqual(len(rows), json.loads(self.client().get('/questions').data)['total_questions'])
+
+    def test_get_questions_server_timing_header(self):
+        res = self.client().get('/questions')
+        timing = dict(part.strip().split(';')[0:2] for part in res.headers['Server-Timing'].split(','))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(timing), {'sql', 'orm', 'serialize', 'total'})
+        self.assertIn('queries', res.headers['Server-Timing'])
+
+    def test_slow_request_logged_with_sql(self):
+        app = create_app(dict(TEST_CONFIG, SLOW_REQUEST_MS=0))
+        with self.assertLogs('trivia.slow', level='WARNING') as logs:
+            app.test_client().get('/categories/5/questions')
+        record = json.loads(logs.records[0].getMessage())
+
+        self.assertEqual(record['endpoint'], 'retrieve_category_based_questions')
+        self.assertTrue(record['sql_count'])
+        self.assertIn('FROM questions', record['statements'][0]['sql'])
+
+    def test_failed_statement_leaves_no_timing_on_connection(self):
+        with self.app.app_context():
+            connection = db.engine.connect()
+            for attempt in range(3):
+                with self.assertRaises(Exception):
+                    connection.execute('SELECT * FROM no_such_table')
+            info = dict(connection.info)
+            connection.close()
+
+        self.assertNotIn('query_started', info)
+
     # * ----- END OF TESTING PAGINATION ON QUESTION ROUTE ----- *
     
     
@@ -81,6 +264,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_categories'])
         self.assertTrue(len(data['categories']))
         
+    def test_200_get_categories_same_payload_for_each_json_backend(self):
+        expected = json.loads(self.client().get('/categories').data)
+        app = create_app(dict(TEST_CONFIG, JSON_BACKEND='stdlib'))
+        res = app.test_client().get('/categories')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(json.loads(res.data), expected)
+
     def test_405_get_categories_wrong_method(self):
         res = self.client().post('/categories')
         data = json.loads(res.data)
@@ -89,6 +281,19 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'method not allowed')
         
+    def test_200_get_categories_after_category_insert(self):
+        before = json.loads(self.client().get('/categories').data)
+        with self.app.app_context():
+            category = Category(type=self.new_category['type'])
+            category.insert()
+            res = self.client().get('/categories')
+            data = json.loads(res.data)
+            category.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_categories'], before['total_categories'] + 1)
+        self.assertEqual(data['categories'][str(category.id)], 'Animals')
+
     ## ! OPTIONAL PAGINATION - ONLY WORKS IF CATEGORIES REQUIRED PAGINATION 
     """ 
     def test_404_sent_requesting_beyond_valid_page_categories(self):
@@ -153,6 +358,231 @@ class TriviaTestCase(unittest.TestCase):
     # ! ----- OPTIONAL - END OF TESTING UPDATE QUESTION ROUTE ----- *
         
         
+    # * ----- TESTING EXPORT QUESTIONS ROUTE ----- *
+
+    def test_200_export_questions_ndjson(self):
+        res = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), total)
+        self.assertEqual([row['id'] for row in rows], sorted(row['id'] for row in rows))
+
+    def test_200_export_questions_csv_resumed_by_category(self):
+        res = self.client().get('/questions/export?format=csv&category=5&min_id=4')
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['4', '6'])
+
+    def test_400_export_questions_unknown_format(self):
+        res = self.client().get('/questions/export?format=xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # * ----- END OF TESTING EXPORT QUESTIONS ROUTE ----- *
+
+
+    # * ----- TESTING STATS ROUTE ----- *
+
+    def test_200_get_stats(self):
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertEqual(data['categories']['5']['total_questions'], 3)
+        self.assertEqual(data['categories']['5']['difficulty'], {'3': 1, '4': 2})
+
+    def test_200_get_stats_follows_insert_and_delete(self):
+        before = json.loads(self.client().get('/stats').data)
+        created = json.loads(self.client().post('/questions', json=self.new_question).data)['created']
+        after_insert = json.loads(self.client().get('/stats').data)
+        self.client().delete('/questions/{}'.format(created))
+        after_delete = json.loads(self.client().get('/stats').data)
+
+        self.assertEqual(after_insert['total_questions'], before['total_questions'] + 1)
+        self.assertEqual(after_insert['categories']['3']['difficulty']['5'], before['categories']['3']['difficulty'].get('5', 0) + 1)
+        self.assertEqual(after_delete['categories'], before['categories'])
+
+    def test_counters_reconcile_corrects_drift(self):
+        self.client().get('/stats')
+        with self.app.app_context():
+            question_counters.added('3', 5)
+            self.assertEqual(question_counters.reconcile(), -1)
+            self.assertEqual(question_counters.total(), Question.query.count())
+
+    # * ----- END OF TESTING STATS ROUTE ----- *
+
+
+    # * ----- TESTING METRICS ROUTE ----- *
+
+    def test_200_get_metrics(self):
+        self.client().get('/categories/5/questions')
+        self.client().get('/categories/5/questions')
+        res = self.client().get('/metrics')
+        body = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE trivia_http_request_duration_seconds histogram', body)
+        self.assertIn('trivia_http_requests_total{route="/categories/<string:category_id>/questions",method="GET",status="200"}', body)
+        self.assertIn('trivia_cache_requests_total{cache="fragments",result="hit"}', body)
+
+    def test_200_get_metrics_summed_across_workers(self):
+        metrics_dir = tempfile.mkdtemp()
+        with open(os.path.join(metrics_dir, 'metrics_1.json'), 'w') as handle:
+            json.dump({'counters': [['trivia_http_requests_total', [['route', '/stats'], ['method', 'GET'], ['status', '200']], 41]], 'histograms': []}, handle)
+        app = create_app(dict(TEST_CONFIG, METRICS_DIR=metrics_dir))
+        app.test_client().get('/stats')
+        body = app.test_client().get('/metrics').data.decode('utf-8')
+
+        self.assertIn('trivia_http_requests_total{route="/stats",method="GET",status="200"} 42', body)
+
+    def test_200_get_metrics_skips_gauges_of_exited_workers(self):
+        metrics_dir = tempfile.mkdtemp()
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        with open(os.path.join(metrics_dir, 'metrics_{}.json'.format(exited.pid)), 'w') as handle:
+            json.dump({'counters': [['trivia_admission_requests_total', [['route', '/questions/quiz'], ['result', 'admitted']], 5]], 'histograms': [],
+                       'gauges': [['trivia_admission_in_flight', [['route', '/questions/quiz']], 3]]}, handle)
+        app = create_app(dict(TEST_CONFIG, METRICS_DIR=metrics_dir, METRICS_FLUSH_SECONDS=0))
+        app.test_client().post('/questions/quiz', json={'previous_questions': [], 'quiz_category': {'id': 0}})
+        # the worker wrote its file after the request released its slot
+        with open(os.path.join(metrics_dir, 'metrics_{}.json'.format(os.getpid()))) as handle:
+            self.assertIn(['trivia_admission_in_flight', [['route', '/questions/quiz']], 0], json.load(handle)['gauges'])
+        body = app.test_client().get('/metrics').data.decode('utf-8')
+
+        self.assertIn('trivia_admission_requests_total{route="/questions/quiz",result="admitted"} 6', body)
+        self.assertIn('trivia_admission_in_flight{route="/questions/quiz"} 0', body)
+
+    # * ----- END OF TESTING METRICS ROUTE ----- *
+
+
+    # * ----- TESTING ADMISSION CONTROL ----- *
+
+    def test_429_search_client_out_of_tokens(self):
+        app = create_app(dict(TEST_CONFIG, ADMISSION_LIMITS={'retrieve_searched_based_questions': {'rate': 0.5, 'burst': 2}}))
+        client = app.test_client()
+        for attempt in range(2):
+            self.assertEqual(client.post('/questions/search', json={'searchTerm': 'title'}).status_code, 200)
+        res = client.post('/questions/search', json={'searchTerm': 'title'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        # other clients and other routes keep their own budget
+        res = client.post('/questions/search', json={'searchTerm': 'title'}, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(client.get('/questions').status_code, 200)
+
+    def test_429_forwarded_for_spoofing_does_not_reset_bucket(self):
+        app = create_app(dict(TEST_CONFIG, ADMISSION_CLIENT_HEADER='X-Forwarded-For',
+                              ADMISSION_LIMITS={'retrieve_searched_based_questions': {'rate': 0.5, 'burst': 1}}))
+        client = app.test_client()
+        statuses = [client.post('/questions/search', json={'searchTerm': 'title'},
+                                headers={'X-Forwarded-For': '10.9.9.{}, 203.0.113.7'.format(n)}).status_code for n in range(3)]
+
+        self.assertEqual(statuses, [200, 429, 429])
+        res = client.post('/questions/search', json={'searchTerm': 'title'}, headers={'X-Forwarded-For': '203.0.113.8'})
+        self.assertEqual(res.status_code, 200)
+
+    def test_503_quiz_at_concurrency_limit(self):
+        app = create_app(dict(TEST_CONFIG, ADMISSION_LIMITS={'retrieve_quiz_questions': {'concurrency': 1}}, ADMISSION_RETRY_AFTER=3))
+        body = {"quiz_category": {"type": "Entertainment", "id" : 5}}
+        slots = app.extensions['admission']['retrieve_quiz_questions']
+        self.assertTrue(slots.acquire())
+        res = app.test_client().post('/questions/quiz', json=body)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '3')
+        slots.release()
+        self.assertEqual(app.test_client().post('/questions/quiz', json=body).status_code, 200)
+        self.assertEqual(slots.in_flight, 0)
+
+        metrics = app.test_client().get('/metrics').data.decode('utf-8')
+        self.assertIn('trivia_admission_requests_total{route="/questions/quiz",result="overloaded"} 1', metrics)
+        self.assertIn('trivia_admission_in_flight{route="/questions/quiz"} 0', metrics)
+
+    # * ----- END OF TESTING ADMISSION CONTROL ----- *
+
+
+    # * ----- TESTING QUESTION SNAPSHOT ----- *
+
+    def snapshot_app(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app(dict(TEST_CONFIG, SNAPSHOT_PATH=os.path.join(directory, 'questions.snapshot'),
+                                     SNAPSHOT_CHECK_SECONDS=0, SNAPSHOT_EXPORT_SECONDS=0))
+        result = app.test_cli_runner().invoke(args=['export-snapshot'])
+        self.assertIn('19 questions', result.output)
+        return app
+
+    def test_200_snapshot_serves_same_pages(self):
+        client = self.snapshot_app().test_client()
+
+        for path in ('/questions?page=2', '/questions?after_id=12', '/categories/5/questions', '/categories/4/questions?after_id=9'):
+            res = client.get(path)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('desc="0 queries"', res.headers['Server-Timing'])
+            self.assertEqual(json.loads(res.data), json.loads(self.client().get(path).data))
+        self.assertEqual(client.get('/questions?page=1000').status_code, 404)
+
+    def test_200_snapshot_quiz_draws_last_unseen_question(self):
+        client = self.snapshot_app().test_client()
+        res = client.post('/questions/quiz', json = {'previous_questions':[2, 4], "quiz_category": {"type": "Entertainment", "id" : 5}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], 6)
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_snapshot_quiz_deck_ids_copied_out_of_mapping(self):
+        app = self.snapshot_app()
+        with app.app_context():
+            snapshot = snapshot_for(app).current()
+            ids = snapshot.ids(5)
+
+            # decks outlive the generation, so they must not hold views into the mapped file
+            self.assertEqual(sorted(ids), [2, 4, 6])
+            self.assertNotIsInstance(ids, memoryview)
+            self.assertIs(snapshot.ids(5), ids)
+            self.assertEqual(len(snapshot.ids(0)), 19)
+            self.assertEqual(len(snapshot.ids(1000)), 0)
+
+    def test_snapshot_swapped_after_write(self):
+        app = self.snapshot_app()
+        client = app.test_client()
+        total = json.loads(client.get('/categories/3/questions').data)['total_questions']
+        created = json.loads(client.post('/questions', json=self.new_question).data)['created']
+
+        # the write only marks the snapshot stale; reads fall back to the database until it is re-exported
+        res = client.get('/categories/3/questions')
+        self.assertNotIn('desc="0 queries"', res.headers['Server-Timing'])
+        self.assertIn(created, [question['id'] for question in json.loads(res.data)['questions']])
+
+        with app.app_context():
+            self.assertTrue(snapshot_for(app).export_pending())
+            self.assertFalse(snapshot_for(app).export_pending())
+        res = client.get('/categories/3/questions')
+        data = json.loads(res.data)
+        self.assertIn('desc="0 queries"', res.headers['Server-Timing'])
+        self.assertEqual(data['total_questions'], total + 1)
+        self.assertIn(created, [question['id'] for question in data['questions']])
+
+        client.delete('/questions/{}'.format(created))
+        self.assertEqual(json.loads(client.get('/categories/3/questions').data)['total_questions'], total)
+
+    # * ----- END OF TESTING QUESTION SNAPSHOT ----- *
+
+
     # * ----- TESTING DELETE QUESTION ROUTE ----- *
 
     def test_delete_question(self):
@@ -168,6 +598,40 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertEqual(question, None)
         
+    def test_delete_question_minimal(self):
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+        res = self.client().delete('/questions/9?return=minimal')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, {'success': True, 'deleted': 9, 'total_questions': total - 1})
+        self.assertEqual(Question.query.get(9), None)
+
+    def test_422_delete_question_minimal_does_not_exist(self):
+        res = self.client().delete('/questions/1000?return=minimal')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_delete_questions_batch(self):
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+        res = self.client().delete('/questions?ids=10,11,1000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], [10, 11])
+        self.assertEqual(data['not_found'], [1000])
+        self.assertEqual(data['total_questions'], total - 2)
+        self.assertEqual(Question.query.filter(Question.id.in_([10, 11])).count(), 0)
+
+    def test_400_delete_questions_batch_bad_ids(self):
+        res = self.client().delete('/questions?ids=10,ten')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_422_if_question_to_delete_does_not_exist(self):
         res = self.client().delete('/questions/1000')
         data = json.loads(res.data)
@@ -217,6 +681,35 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'method not allowed')
         
     
+    def test_create_questions_bulk(self):
+        rows = [self.new_question, {"question": "", "answer": "x", "category": "3"}, dict(self.new_question, category="1000")]
+        res = self.client().post('/questions/bulk?batch_size=1', json=rows + [self.new_question])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([row['index'] for row in data['created']], [0, 3])
+        self.assertEqual([row['index'] for row in data['errors']], [1, 2])
+        question = Question.query.get(data['created'][1]['id'])
+        self.assertEqual(question.answer, self.new_question['answer'])
+
+    def test_create_questions_bulk_ndjson(self):
+        body = '\n'.join(json.dumps(row) for row in [self.new_question, self.new_question]) + '\nnot json\n'
+        res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_created'], 2)
+        self.assertEqual(data['errors'][0]['index'], 2)
+
+    def test_400_create_questions_bulk_not_a_list(self):
+        res = self.client().post('/questions/bulk', json=self.new_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     # * ----- END OF TESTING CREATE QUESTION ROUTE ----- *
     
     
@@ -274,6 +767,70 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], 0)
         self.assertEqual(len(data['questions']), 0)
         
+    def test_200_get_question_search_fulltext_mode(self):
+        res = self.client().post('/questions/search', json={"searchTerm": "Title", "searchMode": "fulltext"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['id'], 6)
+
+    def test_fulltext_search_pages_by_rank_without_cursor(self):
+        rows = [dict(self.new_question, question='planet ' * (n % 4 + 1) + str(n)) for n in range(25)]
+        self.client().post('/questions/bulk', json=rows)
+        body = {"searchTerm": "planet", "searchMode": "fulltext"}
+
+        seen = []
+        for page in (1, 2, 3):
+            data = json.loads(self.client().post('/questions/search?page={}'.format(page), json=body).data)
+            self.assertIsNone(data['next_cursor'])
+            seen.extend(question['id'] for question in data['questions'])
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+        res = self.client().post('/questions/search?after_id=7', json=body)
+        self.assertEqual(res.status_code, 400)
+
+    def test_200_get_question_search_sees_new_question(self):
+        self.client().post('/questions/search', json={"searchTerm": "wood chuck"})
+        self.client().post('/questions', json=self.new_question)
+        res = self.client().post('/questions/search', json={"searchTerm": "wood chuck"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['total_questions'])
+        self.assertEqual(data['questions'][0]['question'], self.new_question['question'])
+
+    def test_200_search_results_cached_by_normalized_term(self):
+        first = self.client().post('/questions/search', json={"searchTerm": "title"})
+        hits, misses = search_cache.hits, search_cache.misses
+        res = self.client().post('/questions/search', json={"searchTerm": "  TITLE "})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, first.data)
+        self.assertEqual((search_cache.hits, search_cache.misses), (hits + 1, misses))
+
+        # a write bumps the questions version, which drops every cached page
+        self.client().post('/questions', json=dict(self.new_question, question='Whose title is this?'))
+        data = json.loads(self.client().post('/questions/search', json={"searchTerm": "Title"}).data)
+        self.assertEqual(data['total_questions'], json.loads(first.data)['total_questions'] + 1)
+        self.assertEqual(search_cache.misses, misses + 1)
+        self.assertIn('trivia_cache_requests_total{cache="search",result="hit"}', self.client().get('/metrics').data.decode('utf-8'))
+
+    def test_200_search_term_keeps_sharp_s(self):
+        created = json.loads(self.client().post('/questions', json=dict(self.new_question, question='Which Straße is longest?')).data)['created']
+        data = json.loads(self.client().post('/questions/search', json={"searchTerm": "STRAßE"}).data)
+
+        self.assertEqual([question['id'] for question in data['questions']], [created])
+
+    def test_422_get_questions_search_unknown_mode(self):
+        res = self.client().post('/questions/search', json={"searchTerm": "title", "searchMode": "regex"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_422_get_questions_search_without_JSON_body(self):
         res = self.client().post('/questions/search')
         data = json.loads(res.data)
@@ -304,6 +861,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertEqual(data['total_questions'], 3)
 
+    def test_200_get_category_based_question_after_update(self):
+        self.client().get('/categories/5/questions')
+        hits = fragment_cache.hits
+        self.client().get('/categories/5/questions')
+        self.assertEqual(fragment_cache.hits, hits + 3)
+
+        with self.app.app_context():
+            question = Question.query.get(4)
+            answer = question.answer
+            question.answer = 'Brad Pitt'
+            question.update()
+            res = self.client().get('/categories/5/questions')
+            question.answer = answer
+            question.update()
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([q['answer'] for q in data['questions'] if q['id'] == 4], ['Brad Pitt'])
+
     def test_404_sent_requesting_beyond_valid_page_category_based_questions(self):
         #res = self.client().get('/questions?page=1000', json={'difficulty': 1})
         res = self.client().get('/categories/5/questions?page=1000')
@@ -320,6 +896,13 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
+
+    def test_422_non_numeric_category_based_question(self):
+        res = self.client().get('/categories/science/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
         
     def test_405_get_category_based_question_method_not_allowed(self):
         res = self.client().patch('/categories/5/questions')
@@ -354,6 +937,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['previous_questions']),2)
         self.assertEqual(data['total_questions'],2)
         
+    def test_200_get_quiz_questions_last_unseen_question(self):
+        res = self.client().post('/questions/quiz', json = {'previous_questions':[2, 4], "quiz_category": {"type": "Entertainment", "id" : 5}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 6)
+        self.assertEqual(data['previous_questions'], [2, 4, 6])
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_200_get_quiz_questions_all_seen(self):
+        res = self.client().post('/questions/quiz', json = {'previous_questions':[2, 4, 6], "quiz_category": {"type": "Entertainment", "id" : 5}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question'], 0)
+        self.assertEqual(data['total_questions'], 0)
+
     def test_200_get_quiz_questions_all_categories(self):
         res = self.client().post('/questions/quiz', json={"quiz_category": {"type": "click", "id" : 0}})
         data = json.loads(res.data)
@@ -380,6 +982,176 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'method not allowed')
         
+    def test_quiz_session_deals_every_question_once(self):
+        for client in (self.client(), self.snapshot_app().test_client()):
+            res = client.post('/quizzes', json={"quiz_category": {"type": "Entertainment", "id" : 5}})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['success'], True)
+            self.assertEqual(data['total_questions'], 3)
+
+            seen = []
+            for remaining in (2, 1, 0):
+                res = client.post('/quizzes/{}/next'.format(data['token']))
+                question = json.loads(res.data)
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(question['remaining'], remaining)
+                seen.append(question['question']['id'])
+            self.assertEqual(sorted(seen), [2, 4, 6])
+
+            res = client.post('/quizzes/{}/next'.format(data['token']))
+            self.assertEqual(json.loads(res.data)['question'], 0)
+
+    def test_quiz_session_deals_once_under_concurrent_calls(self):
+        session = QuizSession('token', 0, list(range(20000)), 60)
+        dealt = []
+
+        def deal():
+            question_id = session.next()
+            while question_id is not None:
+                dealt.append(question_id)
+                question_id = session.next()
+        threads = [threading.Thread(target=deal) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(dealt), list(range(20000)))
+        self.assertEqual(session.served, 20000)
+
+    def test_quiz_session_deck_unchanged_by_later_writes(self):
+        data = json.loads(self.client().post('/quizzes', json={"quiz_category": {"type": "Entertainment", "id" : 5}}).data)
+        self.client().delete('/questions/2')
+        self.client().post('/questions', json={'question': 'Q', 'answer': 'A', 'category': 5, 'difficulty': 1})
+
+        seen = []
+        while True:
+            question = json.loads(self.client().post('/quizzes/{}/next'.format(data['token'])).data)['question']
+            if question == 0:
+                break
+            seen.append(question['id'])
+        # the deleted question is skipped and the new one was not in the deck
+        self.assertEqual(sorted(seen), [4, 6])
+
+    def test_404_quiz_session_unknown_token(self):
+        res = self.client().post('/quizzes/not-a-token/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource or url not found')
+
+    def test_422_quiz_session_invalid_category(self):
+        res = self.client().post('/quizzes', json={"quiz_category": {"type": "History", "id" : 1000}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_200_get_quiz_questions_batch(self):
+        for client in (self.client(), self.snapshot_app().test_client()):
+            res = client.post('/questions/quiz', json={"quiz_category": {"type": "Entertainment", "id" : 5}, "count": 2})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(data['questions']), 2)
+            self.assertEqual(data['question'], data['questions'][0])
+            self.assertEqual(data['previous_questions'], [question['id'] for question in data['questions']])
+            self.assertEqual(data['total_questions'], 3)
+
+            res = client.post('/questions/quiz', json={"quiz_category": {"type": "Entertainment", "id" : 5}, "count": 10,
+                                                       "previous_questions": data['previous_questions']})
+            data = json.loads(res.data)
+            self.assertEqual(len(data['questions']), 1)
+            self.assertEqual(sorted(data['previous_questions']), [2, 4, 6])
+            self.assertEqual(data['total_questions'], 1)
+
+    def test_400_quiz_questions_invalid_count(self):
+        for count in (0, "3", True):
+            res = self.client().post('/questions/quiz', json={"quiz_category": {"type": "Entertainment", "id" : 5}, "count": count})
+            self.assertEqual(res.status_code, 400)
+
+    def test_200_get_quiz_questions_weighted_by_difficulty(self):
+        # Entertainment holds questions 2 and 4 at difficulty 4 and question 6 at difficulty 3
+        body = {"quiz_category": {"type": "Entertainment", "id" : 5}, "difficulty_weights": {"3": 1}}
+        for client in (self.client(), self.snapshot_app().test_client()):
+            res = client.post('/questions/quiz', json=body)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['question']['id'], 6)
+            self.assertEqual(data['total_questions'], 3)
+
+            res = client.post('/questions/quiz', json=dict(body, previous_questions=[6]))
+            self.assertEqual(json.loads(res.data)['question'], 0)
+
+    def test_200_get_quiz_questions_adaptive_target(self):
+        res = self.client().post('/questions/quiz', json={"quiz_category": {"type": "click", "id" : 0},
+                                                          "adaptive": True, "answers": [True, True, False, True]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['target_difficulty'], 4)
+        self.assertTrue(len(data['question']))
+
+    def test_400_quiz_questions_invalid_difficulty(self):
+        category = {"type": "Entertainment", "id" : 5}
+        for settings in ({"difficulty": "hard"}, {"difficulty_weights": {"3": -1}}, {"difficulty_weights": {"3": 0}},
+                         {"difficulty_weights": {"3": 1}, "adaptive": True}, {"adaptive": True, "answers": ["yes"]}):
+            res = self.client().post('/questions/quiz', json=dict(settings, quiz_category=category))
+            self.assertEqual(res.status_code, 400)
+        # the JSON parser accepts NaN and Infinity, which no curve can weigh
+        for body in ('{"difficulty": NaN}', '{"difficulty": Infinity}', '{"difficulty_weights": {"3": Infinity}}'):
+            for path in ('/questions/quiz', '/quizzes'):
+                res = self.client().post(path, data=body, content_type='application/json')
+                self.assertEqual(res.status_code, 400)
+
+    def test_weighted_quiz_session_counts_drawable_questions(self):
+        category = {"type": "Entertainment", "id" : 5}
+        for client in (self.client(), self.snapshot_app().test_client()):
+            res = client.post('/quizzes', json={"quiz_category": category, "difficulty_weights": {"9": 1}})
+            self.assertEqual(res.status_code, 422)
+            self.assertEqual(json.loads(res.data)['success'], False)
+
+            res = client.post('/quizzes', json={"quiz_category": category, "difficulty_weights": {"4": 1}})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['total_questions'], 2)
+
+    def test_adaptive_quiz_session_follows_answers(self):
+        res = self.client().post('/quizzes', json={"quiz_category": {"type": "Entertainment", "id" : 5}, "adaptive": True})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 3)
+        self.assertEqual(data['target_difficulty'], 3)
+
+        seen = []
+        for correct, target, remaining in ((None, 3, 2), (True, 3.5, 1), (True, 4, 0)):
+            res = self.client().post('/quizzes/{}/next'.format(data['token']), json={} if correct is None else {'correct': correct})
+            question = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(question['target_difficulty'], target)
+            self.assertEqual(question['remaining'], remaining)
+            seen.append(question['question']['id'])
+        self.assertEqual(sorted(seen), [2, 4, 6])
+
+        res = self.client().post('/quizzes/{}/next'.format(data['token']), json={'correct': False})
+        data = json.loads(res.data)
+        self.assertEqual(data['question'], 0)
+        self.assertEqual(data['target_difficulty'], 3.5)
+
+    def test_alias_table_follows_weights(self):
+        random.seed(21)
+        table = AliasTable([(1, 1), (2, 0), (3, 3), (4, 6)])
+        draws = [table.sample() for attempt in range(20000)]
+
+        self.assertNotIn(2, draws)
+        for difficulty, share in ((1, 0.1), (3, 0.3), (4, 0.6)):
+            self.assertAlmostEqual(draws.count(difficulty) / len(draws), share, delta=0.02)
+
     ## ! OPTIOANL PAGINATION TEST FOR CATEGORIES ONLY WORKS WITH GET METHOD BUT FRONEND IS USING POST
     """ 
     def test_404_sent_requesting_beyond_valid_page_quiz_questions_specific_category(self):
@@ -407,6 +1179,142 @@ class TriviaTestCase(unittest.TestCase):
     # * ----- END OFTESTING GET QUESTION QUIZ ROUTE ----- *
 
 
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """Reads from a second SQLite file configured as a replica"""
+
+    def setUp(self):
+        handle, self.primary_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        handle, self.replica_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        connection = sqlite3.connect(self.replica_file)
+        connection.execute('CREATE TABLE questions (id INTEGER PRIMARY KEY, question VARCHAR, answer VARCHAR, category_id INTEGER, difficulty INTEGER)')
+        connection.execute("INSERT INTO questions VALUES (1, 'Only on the replica?', 'yes', 1, 1)")
+        connection.commit()
+        connection.close()
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.primary_file,
+            'SQLALCHEMY_REPLICA_URIS': ['sqlite:///' + self.replica_file],
+            'READ_YOUR_WRITES_SECONDS': 5
+        })
+        with self.app.app_context():
+            init_schema()
+        self.client = self.app.test_client()
+        self.new_question = {
+            "question": "Which database answered this?",
+            "answer": "the primary",
+            "category" : "3",
+            "difficulty": 1
+        }
+
+    def tearDown(self):
+        db.get_engine(self.app).dispose()
+        os.remove(self.primary_file)
+        os.remove(self.replica_file)
+
+    def export_ids(self):
+        res = self.client.get('/questions/export')
+        return [json.loads(line)['id'] for line in res.data.decode('utf-8').splitlines()]
+
+    def test_get_reads_from_replica(self):
+        self.assertEqual(self.export_ids(), [1])
+
+    def test_reads_pinned_to_primary_after_write(self):
+        res = self.client.post('/questions', json=self.new_question)
+        created = json.loads(res.data)['created']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(created, self.export_ids())
+
+
+class MigrationsTestCase(unittest.TestCase):
+    """Schema migrations on a database in the trivia.psql layout"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, 'migrations.db')})
+        self.context = self.app.app_context()
+        self.context.push()
+        upgrade(revision=BASELINE_REVISION)
+        db.engine.execute("INSERT INTO categories (id, type) VALUES (1, 'Science'), (2, 'Art')")
+        db.engine.execute("INSERT INTO questions (id, question, answer, category, difficulty) VALUES "
+                          "(1, 'Q1', 'A1', '2', 1), (2, 'Q2', 'A2', '1', 3), (3, 'Q3', 'A3', '2', 5)")
+
+    def tearDown(self):
+        db.engine.dispose()
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_upgrade_backfills_indexed_category_id(self):
+        upgrade(revision='0002', x_arg=['backfill_batch=2'])
+        upgrade()
+        schema = inspect(db.engine)
+        rows = db.engine.execute('SELECT id, category_id FROM questions ORDER BY id').fetchall()
+
+        self.assertEqual([tuple(row) for row in rows], [(1, 2), (2, 1), (3, 2)])
+        self.assertNotIn('category', [column['name'] for column in schema.get_columns('questions')])
+        self.assertEqual(schema.get_foreign_keys('questions')[0]['referred_table'], 'categories')
+        self.assertEqual({index['name']: index['column_names'] for index in schema.get_indexes('questions')},
+                         {'ix_questions_category_id_id': ['category_id', 'id'], 'ix_questions_difficulty': ['difficulty']})
+
+    def test_upgrade_refuses_questions_without_category(self):
+        db.engine.execute("INSERT INTO questions (id, question, answer, category, difficulty) VALUES (4, 'Q4', 'A4', '9', 1)")
+
+        with self.assertRaises(SystemExit):
+            upgrade()
+
+        self.assertEqual(db.engine.execute('SELECT version_num FROM alembic_version').scalar(), '0002')
+
+    def test_downgrade_restores_category_column(self):
+        upgrade()
+        db.engine.execute("INSERT INTO questions (id, question, answer, category_id, difficulty) VALUES (4, 'Q4', 'A4', 1, 1)")
+        downgrade(revision=BASELINE_REVISION)
+        rows = db.engine.execute('SELECT id, category FROM questions ORDER BY id').fetchall()
+
+        self.assertEqual([tuple(row) for row in rows], [(1, '2'), (2, '1'), (3, '2'), (4, '1')])
+
+
+class LifecycleTestCase(unittest.TestCase):
+    """App start-up and connection handling across processes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_file = os.path.join(self.directory, 'lifecycle.db')
+
+    def tearDown(self):
+        if os.path.exists(self.database_file):
+            os.remove(self.database_file)
+        os.rmdir(self.directory)
+
+    def test_create_app_does_not_connect(self):
+        with self.assertLogs('trivia.boot', level='INFO') as logs:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.database_file})
+
+        self.assertFalse(os.path.exists(self.database_file))
+        self.assertIn('create_app ready', logs.output[0])
+
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        with app.app_context():
+            tables = inspect(db.engine).get_table_names()
+            db.engine.dispose()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('questions', tables)
+        self.assertIn('categories', tables)
+
+    def test_connection_from_parent_process_not_reused(self):
+        engine = create_engine('sqlite:///' + self.database_file, poolclass=QueuePool)
+        with engine.connect() as connection:
+            inherited = connection.connection.connection
+            # as if this connection had been opened before the worker forked
+            connection.connection._connection_record.info['pid'] = os.getpid() + 1
+        with engine.connect() as connection:
+            self.assertIsNot(connection.connection.connection, inherited)
+        inherited.close()
+        engine.dispose()
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,23 @@
+import threading
+
+'''
+TableVersions
+    per-table write counters. Model write methods bump the version of the
+    table they touched so in-process caches can tell when they are stale
+    without re-querying.
+'''
+class TableVersions:
+
+  def __init__(self):
+    self._versions = {}
+    self._lock = threading.Lock()
+
+  def get(self, table):
+    return self._versions.get(table, 0)
+
+  def bump(self, table):
+    with self._lock:
+      self._versions[table] = self._versions.get(table, 0) + 1
+      return self._versions[table]
+
+table_versions = TableVersions()